@@ -5,31 +5,64 @@ import shutil
 import subprocess
 import sqlite3
 import atexit
+import time
 from datetime import datetime
 import argparse
 import json
+import threading
+import queue
+import itertools
+import ctypes
+import concurrent.futures
+import fnmatch
+import contextlib
+import resource
+import cProfile
+import tracemalloc
+import hashlib
+import urllib.parse
+import bisect
 
 import configparser
+import shlex
+import tempfile
 
 import pyexiftool.exiftool as exif
 
+# optional in-process HEIC decoder, see the "pillow-heif" conversion backend
+try:
+    from PIL import Image
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    Image = None
+
 ###########
 # HELPERS #
 ###########
 
+# since some work happens in background threads, output is serialized
+OUTPUT_LOCK = threading.RLock()
+
 def log(msg, type='status'):
-    print(" " * 80, end="\r")
-    if type == "status":
-        print('\033[1m' + msg + '\033[0m')
-    if type == "info":
-        print(msg)
-    if type == "warn":
-        print('\033[38;5;208m' + "⚠️  " + msg + '\033[0m')
+    with OUTPUT_LOCK:
+        print(" " * 80, end="\r")
+        if type == "status":
+            print('\033[1m' + msg + '\033[0m')
+        if type == "info":
+            print(msg)
+        if type == "warn":
+            print('\033[38;5;208m' + "⚠️  " + msg + '\033[0m')
+            count("warnings")
     if type == "error":
         sys.exit('\033[31m' + "❌  " + msg + '\033[0m')
 
 # based on https://gist.github.com/vladignatyev/06860ec2040cb497f0f3
 def progress(count, total, status=''):
+    with OUTPUT_LOCK:
+        _progress(count, total, status)
+
+def _progress(count, total, status):
 
     # don't print empty progress bars
     if total == 0:
@@ -69,6 +102,111 @@ def table(assoc):
     for k, v in assoc.items():
         print(str(k).ljust(key_width) + " | " + str(v))
 
+class TemporalIndex:
+    """
+    Values sorted by timestamp, for time-based joins: finds the value nearest to
+    a given timestamp within a tolerance window, one timestamp at a time (by
+    bisection) or for many at once (in a single merge pass).
+    """
+
+    def __init__(self, items):
+        items = sorted(items, key=lambda i: i[0])
+        self.timestamps = [t for t, _ in items]
+        self.values = [v for _, v in items]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _nearest(self, timestamp, lo, hi):
+        # returns the value nearest to timestamp among those at positions lo to
+        # hi (exclusive), and whether there was more than one candidate
+        if lo == hi:
+            return None, False
+        best = min(range(lo, hi), key=lambda i: abs(self.timestamps[i] - timestamp))
+        return self.values[best], hi - lo > 1
+
+    def nearest(self, timestamp, tolerance):
+        """
+        Returns the value nearest to the timestamp, provided it's at most
+        tolerance away, along with whether the match is ambiguous (i.e. there
+        were further candidates within the window), or (None, False).
+        """
+        lo = bisect.bisect_left(self.timestamps, timestamp - tolerance)
+        hi = bisect.bisect_right(self.timestamps, timestamp + tolerance, lo)
+        return self._nearest(timestamp, lo, hi)
+
+    def match_all(self, timestamps, tolerance):
+        """
+        Like nearest, but for many timestamps at once, returning a dict mapping
+        each timestamp to a (value, ambiguous) tuple.
+        """
+        matches = {}
+        lo = hi = 0
+        n = len(self.timestamps)
+        for timestamp in sorted(set(timestamps)):
+            while lo < n and self.timestamps[lo] < timestamp - tolerance:
+                lo += 1
+            hi = max(hi, lo)
+            while hi < n and self.timestamps[hi] <= timestamp + tolerance:
+                hi += 1
+            matches[timestamp] = self._nearest(timestamp, lo, hi)
+        return matches
+
+# Measurements of the phases of a run (see phase), and counts of files, bytes,
+# subprocesses etc. (see count) for the whole run and each phase in progress.
+PHASES = {}
+COUNTERS = {}
+OPEN_PHASES = {}
+COUNTERS_LOCK = threading.Lock()
+
+def peak_memory():
+    # in kilobytes on linux, but in bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def subprocess_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def measurements(start):
+    # unlike times, peak memory can only be had for the process as a whole, up
+    # to now – phases overlap, so it can't be reset for each
+    wall, cpu, subprocess_cpu = start
+    m = {
+        "wall": round(time.perf_counter() - wall, 3),
+        "cpu": round(time.process_time() - cpu, 3),
+        "subprocess_cpu": round(subprocess_cpu_time() - subprocess_cpu, 3),
+        "process_peak_memory_so_far": peak_memory()
+    }
+    if tracemalloc.is_tracing():
+        m["process_peak_traced_memory_so_far"] = tracemalloc.get_traced_memory()[1]
+    return m
+
+def measure():
+    return (time.perf_counter(), time.process_time(), subprocess_cpu_time())
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Records wall time, CPU time (of this process, including other threads, and
+    of finished subprocesses), the peak memory of the process so far and the
+    counts recorded while the phase is in progress. Can be used as a decorator.
+    """
+    start = measure()
+    with COUNTERS_LOCK:
+        OPEN_PHASES[name] = {}
+    try:
+        yield
+    finally:
+        with COUNTERS_LOCK:
+            counters = OPEN_PHASES.pop(name)
+        PHASES[name] = {**measurements(start), **counters}
+
+def count(counter, n=1):
+    with COUNTERS_LOCK:
+        for counters in [COUNTERS] + list(OPEN_PHASES.values()):
+            counters[counter] = counters.get(counter, 0) + n
+
 ############################
 # PARSE ARGUMENTS & CONFIG #
 ############################
@@ -77,6 +215,9 @@ log("Processing arguments...")
 parser = argparse.ArgumentParser()
 parser.add_argument("target", metavar="TARGET", type=str, help="target directory (should also contain configuration)")
 parser.add_argument("-v", "--verbose", action="store_true", dest="verbose", default=False, help="output more verbose status messages")
+parser.add_argument("--profile", action="store_true", dest="profile", default=False, help="additionally trace memory allocations and profile the main thread, writing the results to the target directory")
+parser.add_argument("--benchmark-converters", metavar="N", type=int, nargs="?", const=20, default=None, dest="benchmark_converters", help="measure how many HEIC files per second each available JPEG conversion backend manages (using N sample photos from the library, default 20), then exit")
+parser.add_argument("--watch", metavar="SECONDS", type=float, nargs="?", const=10, default=None, dest="watch", help="keep running and export new imports as they show up in the library, without asking for confirmation (checking every SECONDS seconds, default 10)")
 args = parser.parse_args()
 
 # Target folder.
@@ -100,6 +241,41 @@ TMP = conf["Paths"]["TemporaryStorage"]
 DATABASE = os.path.join(LIBRARY, "database/photos.db")
 TMP_DB   = os.path.join(TMP, "photos.db")
 
+# How photos.db is accessed (see create_working_copy_of_photos_db): "reuse"
+# (the previous run's working copy if the library's database hasn't changed
+# since, otherwise like "backup"), "backup" (consistent snapshot taken with
+# SQLite's online backup API), "copy" (plain file copy, which misses anything
+# still in the write-ahead log), "readonly" (no copy, open the library's
+# database read-only) or "immutable" (like readonly, but without any locking –
+# only safe while Photos isn't running).
+DATABASE_MODE = conf.get("Database", "Mode", fallback="reuse")
+
+# How photos.db is accessed in --watch mode, where it's read after each import –
+# by default in place, since taking a working copy every time would defeat the
+# purpose.
+WATCH_DATABASE_MODE = conf.get("Watch", "DatabaseMode", fallback="readonly")
+
+# In --watch mode, nobody's there to confirm an export, so exports with warnings
+# that may clear up (about a rendered version Photos hasn't finished writing yet,
+# for media about to be recorded as exported, see retryable_warning) are retried
+# this many times, at the polling interval, before being persisted anyway.
+WATCH_RETRIES = conf.getint("Watch", "Retries", fallback=3)
+
+# In --watch mode, the import groups whose number of masters hasn't changed
+# between the two most recent polls (see watch) – only these are recorded as
+# exported, while those Photos may still be adding to are looked at again once
+# they've settled. None outside of --watch mode.
+SETTLED_IMPORT_GROUPS = None
+
+# Stands in for the import group of masters without one, which are recorded as
+# exported under it (like the import groups of all other masters), such that
+# they're exported once, as always.
+NO_IMPORT_GROUP = ""
+
+# Working copy kept between runs for the "reuse" mode, along with the identity
+# of the database it has been taken from (and the DERIVATIVE_CACHE).
+DB_CACHE = os.path.normpath(TMP) + "-cache"
+
 # "Raw" images and videos, e.g. IMG_0042.{HEIC,MOV,PNG,JPG} (photos, vids,
 # screenshots, bursts respectively). Images received by WhatsApp or exported
 # from Dropbox etc. also show up here, but for the most part don't follow the
@@ -115,16 +291,120 @@ MASTER = os.path.join(LIBRARY, "resources/media/master")
 # been edited on the phone, etc.
 VERSION = os.path.join(LIBRARY, "resources/media/version")
 
-# Import groups to be ignored (i.e. those that have already been processed).
-IGNORE_IMPORT_GROUPS = []
-
-# Mapping between content identifiers and file names for live photo videos.
-LIVE_PHOTO_VIDEOS = {}
-
-# Media files written to temporary storage. If the user confirms that everything
-# went smoothly, these will be copied to the TARGET.
+# Export state, kept in an SQLite database in the TARGET that's updated
+# incrementally (see open_state): already-exported import groups, the index of
+# live photo videos, previously extracted metadata of video files (such that
+# only new or changed files need to be passed to exiftool, see
+# extract_metadata), exported files, and runs.
+STATE_DB = os.path.join(TARGET, "apple-photos-export.db")
+STATE = None
+STATE_LOCK = threading.RLock()
+
+# Row ID of the current run in the runs table of the export state.
+RUN_ID = None
+
+# The only tags ever extracted (and thus cached), and the exiftool -fast level
+# used for doing so by default – Live Photo videos and rendered slomos carry them
+# in their QuickTime metadata, so there's no need to look at maker notes. Edited
+# photos, however, have their content identifier in Apple's maker notes, so
+# rendered versions are looked at with -fast (see build_version_index).
+CACHED_TAGS = ["QuickTime:ContentIdentifier", "QuickTime:DateTimeOriginal", "Apple:ContentIdentifier"]
+EXIFTOOL_FAST = 2
+EXIFTOOL_FAST_VERSIONS = 1
+
+# Snapshot of the directory trees scanned for videos, mapping directories to
+# [mtime, files, subdirectories], such that only directories modified since the
+# previous run need to be listed again (see scan_directory).
+DIRECTORY_SNAPSHOT = {}
+
+# Maximum difference, in seconds, between the modification date of a slomo
+# video's attachment and the creation date of the rendered slomo video.
+RENDERED_SLOMO_TOLERANCE = conf.getint("Matching", "RenderedSlomoTolerance", fallback=2)
+
+# Number of directories listed concurrently when scanning for videos.
+SCAN_WORKERS = 8
+
+# Number of exiftool processes metadata extraction is spread across, and the
+# number of seconds after which an unresponsive one is restarted.
+EXIFTOOL_PROCESSES = conf.getint("Metadata", "ExifToolProcesses", fallback=os.cpu_count() or 1)
+EXIFTOOL_TIMEOUT = conf.getint("Metadata", "ExifToolTimeout", fallback=300)
+
+# Library files the staged (or converted) files originate from, see
+# record_exported_files.
+SOURCES = {}
+
+# Sizes and modification times of the files in the TARGET as of the start of
+# the run, keyed by path (see scan_target), and the target paths of files
+# skipped since they're already there with the same content (see stage_file).
+TARGET_FILES = {}
+IDENTICAL = []
+
+# Media files written to temporary storage, as (staged path, source path)
+# tuples, where the source path is only set if the file hasn't actually been
+# written to the staging directory (see STAGING). If the user confirms that
+# everything went smoothly, these will be moved or copied to the TARGET.
 TMP_FILES = []
 
+# How exported media files get to the TARGET (see choose_staging_strategy):
+# "rename" (copy to a staging directory within the TARGET, then rename),
+# "link" (hardlink into temporary storage, then copy), "manifest" (just record
+# what needs copying, then copy straight from the library), "copy" (copy to
+# temporary storage, then copy again) or "auto".
+STAGING = conf.get("Staging", "Strategy", fallback="auto")
+
+# Directory exported media files are staged in, depends on STAGING.
+STAGE = TMP
+
+# Number of files copied concurrently when persisting to the TARGET, separately
+# for small files (photos) and large ones (videos larger than the threshold,
+# given in megabytes).
+COPY_WORKERS_SMALL = conf.getint("Copying", "SmallFileWorkers", fallback=8)
+COPY_WORKERS_LARGE = conf.getint("Copying", "LargeFileWorkers", fallback=2)
+LARGE_FILE_THRESHOLD = conf.getint("Copying", "LargeFileThreshold", fallback=64) * 1024 * 1024
+
+# What happens to files whose content has already been exported to the TARGET
+# under another name, e.g. WhatsApp forwards or photos imported more than once
+# (see deduplicate): "link" hardlinks them to the existing file, "skip" doesn't
+# persist them at all, and "off" copies them like any other file.
+DEDUPLICATION = conf.get("Copying", "Deduplication", fallback="link")
+
+# Duplicates found while persisting, as {"path", "original"} dicts, and files
+# that would have overwritten different ones, as {"path", "written_to"} dicts,
+# with paths relative to the TARGET, for the report.
+DUPLICATES = []
+CONFLICTS = []
+
+# Buffer size used when copying files without kernel assistance.
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Number of HEIC-to-JPEG conversions running concurrently (with each other and
+# with the copying of files to temporary storage).
+CONVERSION_WORKERS = conf.getint("Conversion", "Workers", fallback=os.cpu_count() or 1)
+
+# Backend used for creating JPEG versions of HEIC files: "sips" (one process
+# per photo), "pillow-heif" (in-process, requires the pillow-heif package) or
+# "command" (external command built from COMMAND_TEMPLATE).
+CONVERTER = conf.get("Conversion", "Backend", fallback="sips")
+
+# The "sips" executable used by the "sips" backend. Can be pointed to a
+# stand-in command with the same interface for testing purposes.
+SIPS = conf.get("Conversion", "Sips", fallback="sips")
+
+# Command line for the "command" backend, with placeholders {heic}, {jpeg} and
+# {quality}, e.g. "heif-convert -q {quality} {heic} {jpeg}".
+COMMAND_TEMPLATE = conf.get("Conversion", "CommandTemplate", fallback="")
+
+# Quality of the JPEG versions of HEIC files.
+JPEG_QUALITY = 80
+
+# JPEG versions of HEIC files are kept in a cache that survives aborted runs
+# (unlike the temporary storage), keyed by the HEIC file and the conversion
+# settings, such that retries don't have to convert anything again. Once it
+# exceeds its size (in megabytes, 0 disables it), the least recently used ones
+# are evicted.
+DERIVATIVE_CACHE = os.path.join(DB_CACHE, "derivatives")
+DERIVATIVE_CACHE_SIZE = conf.getint("Conversion", "CacheSize", fallback=2048) * 1024 * 1024
+
 
 ################################################################################
 
@@ -135,7 +415,7 @@ AND (m.mediaGroupId IS NOT NULL OR m.groupingUuid IS NOT NULL)
 """
 
 IS_VIDEO = """
-UTI = 'com.apple.quicktime-movie'
+m.UTI = 'com.apple.quicktime-movie'
 """
 
 IS_BURST = """
@@ -200,52 +480,325 @@ IS_WHATSAPP_VIDEO = """
 m.UTI = 'public.mpeg-4'
 """ + IS_WHATSAPP
 
-# query helper
+# persistent connection to the working copy of the database, see connect_db
+DB = None
+
+def database_uri(path, **params):
+    return "file:" + urllib.parse.quote(path) + ("?" + urllib.parse.urlencode(params) if params else "")
+
+def connect_db(path, **params):
+    global DB
+    DB = sqlite3.connect(database_uri(path, **params), uri=True, check_same_thread=False)
+
+def disconnect_db():
+    global DB
+    if DB is not None:
+        DB.close()
+        DB = None
+
+# query helpers
 def query(q):
-    conn = sqlite3.connect(TMP_DB)
-    c = conn.cursor()
+    c = DB.cursor()
     c.execute(q)
     res = list(c)
-    conn.close()
     return res
 
+# Number of rows fetched at a time by iterquery.
+QUERY_BATCH_SIZE = 1000
+
+def iterquery(q):
+    c = DB.cursor()
+    c.execute(q)
+    while True:
+        rows = c.fetchmany(QUERY_BATCH_SIZE)
+        if not rows:
+            break
+        yield from rows
+
 def pred(*preds):
     return " WHERE (" + ") AND (".join(preds) + ")"
 
-def pnot(pred):
-    return " NOT (" + pred + ")"
-
-# TODO also keep cache of video metadata in this file – will cut down on long wait right at the start
 # TODO maybe: "that means you've run this thingy most recently between x and y (can get this info based on grouping by import id and getting min/mix timestamp for the newest known and oldest unknown)"
+@phase("read_cache")
 def read_cache():
     log("Reading and processing cache (list of already-exported Apple Photos imports, live photo video index)...")
 
-    global IGNORE_IMPORT_GROUPS
-    global LIVE_PHOTO_VIDEOS
+    open_state()
+
+    # (unless it's still in memory from a previous run, see watch)
+    global DIRECTORY_SNAPSHOT
+    if DIRECTORY_SNAPSHOT:
+        return
     try:
-        with open(os.path.join(TARGET, "apple-photos-export.json"), "r") as f:
-            data = json.load(f)
-            IGNORE_IMPORT_GROUPS = data['IGNORE_IMPORT_GROUPS']
-            LIVE_PHOTO_VIDEOS = data['LIVE_PHOTO_VIDEOS']
+        with open(os.path.join(TARGET, "apple-photos-export-snapshot.json"), "r") as f:
+            DIRECTORY_SNAPSHOT = json.load(f)
     except FileNotFoundError:
         pass
 
-def only_relevant_import_groups():
-    return "m.importGroupUuid NOT IN (" + ','.join(["'" + g + "'" for g in IGNORE_IMPORT_GROUPS]) + ")"
+def write_directory_snapshot():
+    with open(os.path.join(TARGET, "apple-photos-export-snapshot.json"), "w") as f:
+        json.dump(DIRECTORY_SNAPSHOT, f)
+
+def list_directory(directory):
+    """
+    Returns the snapshot entry of a directory, listing it only if it has been
+    modified since the snapshot was taken. Since a directory's mtime only
+    changes when entries are added to or removed from it directly, unchanged
+    directories still need to be descended into, but that's a stat() call each
+    rather than a full listing.
+    """
+    mtime = os.stat(directory).st_mtime_ns
+    entry = DIRECTORY_SNAPSHOT.get(directory)
+    if entry and entry[0] == mtime:
+        return entry, False
+
+    files = []
+    subdirectories = []
+    with os.scandir(directory) as it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                subdirectories.append(e.name)
+            else:
+                files.append(e.name)
+    return [mtime, files, subdirectories], True
+
+def scan_directory(root, *patterns):
+    """
+    Returns the sorted paths of all files below root whose names match any of
+    the patterns, like a recursive glob, but listing directories in parallel and only
+    if they've changed since the previous run.
+    """
+    if not os.path.isdir(root):
+        return []
+
+    seen = set()
+    changed = 0
+    paths = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        pending = {pool.submit(list_directory, root): root}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                directory = pending.pop(future)
+                entry, listed = future.result()
+                DIRECTORY_SNAPSHOT[directory] = entry
+                seen.add(directory)
+                changed += listed
+                _, files, subdirectories = entry
+                paths.extend(os.path.join(directory, f) for f in files if any(fnmatch.fnmatchcase(f, p) for p in patterns))
+                for d in subdirectories:
+                    subdirectory = os.path.join(directory, d)
+                    pending[pool.submit(list_directory, subdirectory)] = subdirectory
+
+    # forget about directories that have disappeared
+    prefix = os.path.join(root, "")
+    for directory in list(DIRECTORY_SNAPSHOT.keys()):
+        if (directory == root or directory.startswith(prefix)) and directory not in seen:
+            del DIRECTORY_SNAPSHOT[directory]
+
+    if VERBOSE:
+        log("Listed " + str(changed) + " new or modified out of " + str(len(seen)) + " directories below " + root + ".", "info")
+    write_directory_snapshot()
+    return sorted(paths)
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started TEXT, completed TEXT);
+CREATE TABLE IF NOT EXISTS import_groups (uuid TEXT PRIMARY KEY, run INTEGER) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS live_photo_videos (contentidentifier TEXT PRIMARY KEY, path TEXT) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS live_photo_videos_path ON live_photo_videos (path);
+CREATE TABLE IF NOT EXISTS metadata (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, tags TEXT) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS exported_files (path TEXT PRIMARY KEY, source TEXT, run INTEGER) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS contents (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, partial TEXT, full TEXT) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS contents_size ON contents (size);
+"""
 
+# Version of the STATE_SCHEMA, see migrate_state_schema.
+STATE_SCHEMA_VERSION = 2
+
+def migrate_state_schema():
+    STATE.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+
+    # rendered versions (at first only rendered slomos, keyed by timestamp) used
+    # to be kept in the export state, too, though they're rebuilt on every run
+    # and only ever looked up in memory (see build_version_index)
+    for table in ["rendered_slomos", "rendered_versions"]:
+        STATE.execute("DROP TABLE IF EXISTS " + table)
+
+def open_state():
+    """
+    Opens (or creates) the export state unless it's still open from a previous
+    run (see watch), migrates the JSON cache files of earlier versions if
+    present, registers the run and attaches the state to the working copy of the
+    database, where only_relevant_import_groups needs it.
+    """
+    global STATE
+    global RUN_ID
+    if STATE is None:
+        connect_state()
+    with STATE_LOCK, STATE:
+        RUN_ID = STATE.execute("INSERT INTO runs (started) VALUES (?)", (datetime.now().isoformat(),)).lastrowid
+    DB.execute("ATTACH DATABASE ? AS state", (STATE_DB,))
+
+def connect_state():
+    global STATE
+    STATE = sqlite3.connect(STATE_DB, check_same_thread=False)
+    with STATE_LOCK, STATE:
+        STATE.execute("PRAGMA journal_mode = WAL")
+        STATE.execute("PRAGMA synchronous = NORMAL")
+        migrate_state_schema()
+        STATE.executescript(STATE_SCHEMA)
+        STATE.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('schema_version', ?)", (str(STATE_SCHEMA_VERSION),))
+
+        # metadata extracted for a different set of tags is useless
+        cached_tags = STATE.execute("SELECT value FROM settings WHERE key = 'cached_tags'").fetchone()
+        if not cached_tags or json.loads(cached_tags[0]) != CACHED_TAGS:
+            STATE.execute("DELETE FROM metadata")
+            STATE.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('cached_tags', ?)", (json.dumps(CACHED_TAGS),))
+
+    migrate_json_cache()
+
+def migrate_json_cache():
+    """
+    One-time migration of the apple-photos-export.json and
+    apple-photos-export-metadata.json files written by earlier versions, which
+    are renamed to *.migrated afterwards.
+    """
+    path = os.path.join(TARGET, "apple-photos-export.json")
+    if os.path.isfile(path):
+        log("Migrating " + path + " to " + STATE_DB + "...", "info")
+        with open(path, "r") as f:
+            data = json.load(f)
+        with STATE_LOCK, STATE:
+            STATE.executemany("INSERT OR IGNORE INTO import_groups (uuid) VALUES (?)",
+                              ((NO_IMPORT_GROUP if g is None else g,) for g in data['IGNORE_IMPORT_GROUPS']))
+            STATE.executemany("INSERT OR IGNORE INTO live_photo_videos (contentidentifier, path) VALUES (?, ?)",
+                              data['LIVE_PHOTO_VIDEOS'].items())
+        os.replace(path, path + ".migrated")
+
+    path = os.path.join(TARGET, "apple-photos-export-metadata.json")
+    if os.path.isfile(path):
+        log("Migrating " + path + " to " + STATE_DB + "...", "info")
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get('CACHED_TAGS') == CACHED_TAGS:
+            with STATE_LOCK, STATE:
+                STATE.executemany("INSERT OR IGNORE INTO metadata (path, size, mtime_ns, tags) VALUES (?, ?, ?, ?)",
+                                  ((p, size, mtime, json.dumps(tags)) for p, (size, mtime, tags) in data['FILES'].items()))
+        os.replace(path, path + ".migrated")
+
+def close_state():
+    global STATE
+    if STATE is not None:
+        with STATE_LOCK:
+            STATE.close()
+            STATE = None
+
+# pool of exiftool processes shared by all metadata extraction, started on first
+# use and terminated in clean_up
+EXIFTOOL_POOL = None
+
+def exiftool_pool():
+    global EXIFTOOL_POOL
+    if EXIFTOOL_POOL is None:
+        EXIFTOOL_POOL = exif.ExifToolPool(EXIFTOOL_PROCESSES, timeout=EXIFTOOL_TIMEOUT)
+        EXIFTOOL_POOL.start()
+        count("subprocesses", EXIFTOOL_POOL.size)
+    return EXIFTOOL_POOL
+
+def terminate_exiftool_pool():
+    global EXIFTOOL_POOL
+    if EXIFTOOL_POOL is not None:
+        if EXIFTOOL_POOL.restarts:
+            count("subprocesses", EXIFTOOL_POOL.restarts)
+            log("Had to restart " + str(EXIFTOOL_POOL.restarts) + " unresponsive exiftool processes.", "warn")
+        EXIFTOOL_POOL.terminate()
+        EXIFTOOL_POOL = None
+
+def extract_metadata(paths, fast=EXIFTOOL_FAST):
+    """
+    Yields a dict with the CACHED_TAGS (where present) and the SourceFile for
+    each of the given files, in order. Only files not already in the metadata
+    cache (or modified since) are passed to exiftool, whose results are streamed
+    in chunks as they come in.
+    """
+    identities = {}
+    cached = {}
+    missing = []
+    with STATE_LOCK:
+        for p in paths:
+            identities[p] = identity(p)
+            row = STATE.execute("SELECT size, mtime_ns, tags FROM metadata WHERE path = ?", (p,)).fetchone()
+            if row and list(row[:2]) == identities[p]:
+                cached[p] = json.loads(row[2])
+            else:
+                missing.append(p)
+
+    if missing:
+        log("Batch-extracting metadata of " + str(len(missing)) + " new or changed files (this might take a minute or three)...", "info")
+        count("exiftool_files", len(missing))
+        metadata = exiftool_pool().iter_tags(CACHED_TAGS, missing, fast=fast)
+    else:
+        log("All metadata already cached, no need to run exiftool.", "info")
+        metadata = iter([])
+
+    # exiftool processes files in order, so consume its output up to (and
+    # including) each missing file
+    extracted = []
+    missing = set(missing)
+    for p in paths:
+        if p in missing:
+            for d in metadata:
+                tags = {k: d[k] for k in CACHED_TAGS if k in d}
+                if d["SourceFile"] in identities:
+                    cached[d["SourceFile"]] = tags
+                    extracted.append((d["SourceFile"], *identities[d["SourceFile"]], json.dumps(tags)))
+                if d["SourceFile"] == p:
+                    break
+        if p in cached:
+            yield {**cached[p], "SourceFile": p}
+
+    if extracted:
+        with STATE_LOCK, STATE:
+            STATE.executemany("INSERT OR REPLACE INTO metadata (path, size, mtime_ns, tags) VALUES (?, ?, ?, ?)", extracted)
+
+def only_relevant_import_groups():
+    # the import groups not yet exported are determined from the (indexed)
+    # export state attached to the working copy, such that only their masters
+    # need to be looked at (if indexed, see prepare_database)
+    return """(m.importGroupUuid IS NULL AND NOT EXISTS (SELECT 1 FROM state.import_groups g WHERE g.uuid = '""" + NO_IMPORT_GROUP + """'))
+        OR m.importGroupUuid IN (
+        SELECT DISTINCT r.importGroupUuid FROM RKMaster r
+        WHERE NOT EXISTS (SELECT 1 FROM state.import_groups g WHERE g.uuid = r.importGroupUuid))"""
+
+@phase("write_cache")
 def write_cache():
     log("Updating cache (list of already-exported Apple Photos imports, live photo video index)...")
 
-    q = "SELECT DISTINCT m.importGroupUuid FROM RKMaster m ORDER BY m.modelId"
-    import_groups = [r[0] for r in query(q)]
-
-    data = {
-        'IGNORE_IMPORT_GROUPS': import_groups,
-        'LIVE_PHOTO_VIDEOS': LIVE_PHOTO_VIDEOS
-    }
-
-    with open(os.path.join(TARGET, "apple-photos-export.json"), "w") as f:
-        json.dump(data, f)
+    # the live photo video index has been updated while building it, so only
+    # the import groups and the run remain – only those actually enumerated
+    # count as exported, since in the readonly and immutable database modes,
+    # Photos may have added more in the meantime
+    groups = ENUMERATED_IMPORT_GROUPS
+    if SETTLED_IMPORT_GROUPS is not None:
+        groups = groups & SETTLED_IMPORT_GROUPS
+    with STATE_LOCK, STATE:
+        STATE.executemany("INSERT OR IGNORE INTO import_groups (uuid, run) VALUES (?, ?)",
+                          ((g, RUN_ID) for g in groups))
+        STATE.execute("UPDATE runs SET completed = ? WHERE id = ?", (datetime.now().isoformat(), RUN_ID))
+
+def live_photo_video(contentidentifier):
+    with STATE_LOCK:
+        row = STATE.execute("SELECT path FROM live_photo_videos WHERE contentidentifier = ?", (contentidentifier,)).fetchone()
+    return row[0] if row else None
+
+def record_exported_files(files):
+    """
+    Records (path relative to the TARGET, source path) tuples of exported files.
+    """
+    with STATE_LOCK, STATE:
+        STATE.executemany("INSERT OR REPLACE INTO exported_files (path, source, run) VALUES (?, ?, ?)",
+                          ((path, source, RUN_ID) for path, source in files))
 
 # as a sanity check, keep track of number of photos processed
 TALLY = {"written": {}, "ignored": {}, "total": {}}
@@ -256,28 +809,42 @@ def tally(mode, category):
     else:
         TALLY[mode][category] = TALLY[mode][category] + 1
 
+# since all categories are processed at once, the order of tallies depends on
+# the order of media in the database, so it's fixed here for the summary
+TALLY_ORDER = [
+    "Photos", "Photos as JPEG", "Live photo videos",
+    "Edited photos", "Edited live photo videos", "Edits of photos without content identifier",
+    "Videos", "Rendered slomos",
+    "Burst mode photos",
+    "Panoramas", "Panoramas as JPEG",
+    "Square photos", "Square photos as JPEG",
+    "Instagrammed photos",
+    "Screenshots", "Screen recordings", "WhatsApp images", "WhatsApp videos",
+    "Unknown/uncategorized media",
+    "Considered", "In database"
+]
+
+def ordered(tallies):
+    key = lambda c: TALLY_ORDER.index(c) if c in TALLY_ORDER else len(TALLY_ORDER)
+    return {c: tallies[c] for c in sorted(tallies.keys(), key=key)}
+
 def stats():
-    q = """
-        SELECT COUNT(*)
-        FROM RKMaster m
-    """ + pred(only_relevant_import_groups())
-    items = query(q)[0][0]
-    for i in range(items):
+    for i in range(MEDIA_TOTAL):
         tally("total", "In database")
 
     log("Summary:")
     log("The following media were successfully exported:", "info")
-    table(TALLY["written"])
+    table(ordered(TALLY["written"]))
 
     log("These media were found, but ignored:", "info")
-    table(TALLY["ignored"])
+    table(ordered(TALLY["ignored"]))
 
     log("In total:", "info")
-    table(TALLY["total"])
+    table(ordered(TALLY["total"]))
 
-def log_file(path):
+def log_file(path, sourcepath=None):
     global TMP_FILES
-    TMP_FILES.append(path)
+    TMP_FILES.append((path, sourcepath))
 
 def weird_apple_timestamp_to_unix(ts):
     return int(ts) + 977616000 + 691200  # + 31 years + 8 leap days, for whatever reason
@@ -288,77 +855,1127 @@ def assemble_filename_prefix(creationdate, id):
     datestring = datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
     datestring = datestring.replace(" ", "_").replace(":", "-")
     yearmonth = datetime.utcfromtimestamp(ts).strftime('%Y/%m_%B')
-    directory = os.path.join(TMP, yearmonth)
+    directory = os.path.join(STAGE, yearmonth)
     filename_prefix = os.path.join(directory, datestring + "_" + str(id) + "_")
     return filename_prefix
 
-def jpeg_from_heic(heicfile, jpegfile, quality=80):
+def jpeg_from_heic_sips(heicfile, jpegfile, quality):
+    count("subprocesses")
+    subprocess.check_output([SIPS, "-s", "format", "jpeg", "-s", "formatOptions", str(quality), heicfile, "--out", jpegfile])
+
+def jpeg_from_heic_pillow(heicfile, jpegfile, quality):
+    # carry over EXIF data and the color profile (usually Display P3), like sips
+    with Image.open(heicfile) as img:
+        options = {}
+        for key in ["exif", "icc_profile"]:
+            if img.info.get(key):
+                options[key] = img.info[key]
+        img.save(jpegfile, "JPEG", quality=quality, **options)
+
+def jpeg_from_heic_command(heicfile, jpegfile, quality):
+    cmd = [a.format(heic=heicfile, jpeg=jpegfile, quality=quality) for a in shlex.split(COMMAND_TEMPLATE)]
+    count("subprocesses")
+    subprocess.check_output(cmd)
+
+CONVERTERS = {
+    "sips": jpeg_from_heic_sips,
+    "pillow-heif": jpeg_from_heic_pillow,
+    "command": jpeg_from_heic_command
+}
+
+def available_converters():
+    available = []
+    if shutil.which(SIPS):
+        available.append("sips")
+    if Image is not None:
+        available.append("pillow-heif")
+    if COMMAND_TEMPLATE and shutil.which(shlex.split(COMMAND_TEMPLATE)[0]):
+        available.append("command")
+    return available
+
+def check_converter():
+    if CONVERTER not in CONVERTERS:
+        log("Unknown conversion backend " + CONVERTER + " (should be one of: " + ", ".join(CONVERTERS.keys()) + ")", "error")
+    if CONVERTER not in available_converters():
+        log("Conversion backend " + CONVERTER + " isn't available on this system (available: " + ", ".join(available_converters()) + ")", "error")
+
+def jpeg_from_heic(heicfile, jpegfile, quality=JPEG_QUALITY, backend=None):
+    CONVERTERS[backend or CONVERTER](heicfile, jpegfile, quality)
+
+def benchmark_converters(n):
+    log("Benchmarking JPEG conversion backends...")
+    samples = []
+    for p in glob.iglob(MASTERS + '/**/*.HEIC', recursive=True):
+        samples.append(p)
+        if len(samples) == n:
+            break
+    if not samples:
+        log("Couldn't find any HEIC files in " + MASTERS, "error")
+    log("Using " + str(len(samples)) + " sample photos.", "info")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for backend in available_converters():
+            start = time.perf_counter()
+            progress(0, len(samples))
+            for i, heicfile in enumerate(samples):
+                jpegfile = os.path.join(tmpdir, backend + "_" + str(i) + ".jpg")
+                try:
+                    jpeg_from_heic(heicfile, jpegfile, backend=backend)
+                except Exception as err:
+                    log(backend + " failed: " + repr(err), "warn")
+                    break
+                progress(i+1, len(samples), backend)
+            else:
+                elapsed = time.perf_counter() - start
+                results[backend] = str(round(len(samples) / elapsed, 1)) + " images/second"
+    table(results)
+
+# pending conversions as (negative source file size, sequence number, job)
+# tuples, such that the largest files are converted first and the tail is short
+CONVERSION_QUEUE = queue.PriorityQueue()
+CONVERSION_SEQUENCE = itertools.count()
+CONVERSION_THREADS = []
+CONVERSION_ERRORS = []
+
+def conversion_worker():
+    while True:
+        _, _, job = CONVERSION_QUEUE.get()
+        try:
+            if job is None:
+                return
+            heicfile, jpegfile = job
+            try:
+                if cached_derivative(heicfile, jpegfile):
+                    count("cached_conversions")
+                else:
+                    jpeg_from_heic(heicfile, jpegfile)
+                    cache_derivative(heicfile, jpegfile)
+                    count("conversions")
+                journal("convert", jpegfile, heicfile)
+            except Exception as err:
+                CONVERSION_ERRORS.append(CONVERTER + " failed: " + repr(err))
+        finally:
+            CONVERSION_QUEUE.task_done()
+
+def derivative_path(heicfile):
+    key = [os.path.abspath(heicfile), identity(heicfile), JPEG_QUALITY, CONVERTER]
+    if CONVERTER == "command":
+        key.append(COMMAND_TEMPLATE)
+    return os.path.join(DERIVATIVE_CACHE, hashlib.blake2b(json.dumps(key).encode(), digest_size=16).hexdigest() + ".jpg")
+
+def cached_derivative(heicfile, jpegfile):
+    """
+    Copies the cached JPEG version of heicfile to jpegfile, if there is one,
+    and returns whether there was.
+    """
+    if DERIVATIVE_CACHE_SIZE <= 0:
+        return False
+    path = derivative_path(heicfile)
+    try:
+        clone_or_copy(path, jpegfile)
+        os.utime(path)  # for evict_derivatives
+    except FileNotFoundError:
+        return False
+    return True
+
+def cache_derivative(heicfile, jpegfile):
+    """
+    Adds jpegfile to the cache as a copy-on-write clone or, failing that, as a
+    copy – unless it has been staged within the TARGET (see the rename
+    strategy), which is usually on another file system, such that every JPEG
+    would be written twice just for what the journal already covers.
+    """
+    if DERIVATIVE_CACHE_SIZE <= 0:
+        return
+    path = derivative_path(heicfile)
+    tmppath = path + "." + str(threading.get_ident())
+    os.makedirs(DERIVATIVE_CACHE, exist_ok=True)
+    if not clone_file(jpegfile, tmppath):
+        if STAGING == "rename":
+            if os.path.lexists(tmppath):
+                os.remove(tmppath)
+            return
+        copy_file(jpegfile, tmppath)
+    os.replace(tmppath, path)
+
+def evict_derivatives():
+    """
+    Removes the least recently used JPEG versions from the cache until it fits
+    DERIVATIVE_CACHE_SIZE.
+    """
+    if not os.path.isdir(DERIVATIVE_CACHE):
+        return
+    entries = []
+    with os.scandir(DERIVATIVE_CACHE) as it:
+        for e in it:
+            st = e.stat()
+            entries.append((st.st_mtime_ns, st.st_size, e.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= DERIVATIVE_CACHE_SIZE:
+            break
+        os.remove(path)
+        total -= size
+        count("evicted_derivatives")
+
+def start_conversion_workers():
+    for i in range(max(1, CONVERSION_WORKERS)):
+        t = threading.Thread(target=conversion_worker, daemon=True)
+        t.start()
+        CONVERSION_THREADS.append(t)
+
+def convert_later(heicfile, jpegfile):
+    if already_done(jpegfile, heicfile):
+        count("resumed")
+        return
+    priority = -os.path.getsize(heicfile)
+    CONVERSION_QUEUE.put((priority, next(CONVERSION_SEQUENCE), (heicfile, jpegfile)))
+
+@phase("finish_conversions")
+def finish_conversions():
+    remaining = CONVERSION_QUEUE.unfinished_tasks
+    if remaining:
+        log("Waiting for remaining JPEG conversions...")
+        done = 0
+        progress(done, remaining)
+        while CONVERSION_QUEUE.unfinished_tasks:
+            if remaining - CONVERSION_QUEUE.unfinished_tasks != done:
+                done = remaining - CONVERSION_QUEUE.unfinished_tasks
+                progress(done, remaining)
+            time.sleep(0.1)
+        if done != remaining:
+            progress(remaining, remaining)
+    CONVERSION_QUEUE.join()
+
+    # shut down workers, the queue is empty at this point
+    for t in CONVERSION_THREADS:
+        CONVERSION_QUEUE.put((0, next(CONVERSION_SEQUENCE), None))
+    for t in CONVERSION_THREADS:
+        t.join()
+    CONVERSION_THREADS.clear()
+    evict_derivatives()
+
+    if CONVERSION_ERRORS:
+        log(CONVERSION_ERRORS[0], "error")
+
+def same_filesystem(path1, path2):
+    return os.stat(path1).st_dev == os.stat(path2).st_dev
+
+def choose_staging_strategy():
+    global STAGING
+    global STAGE
+
+    strategy = STAGING
+    if strategy not in ["auto", "rename", "link", "manifest", "copy"]:
+        log("Unknown staging strategy " + strategy + " (should be one of: auto, rename, link, manifest, copy)", "error")
+
+    # a hidden directory within the target is virtually guaranteed to be on the
+    # same file system as the target, but it doesn't hurt to check
+    rename_stage = os.path.join(TARGET, ".apple-photos-export-staging")
+    leftover = os.path.isdir(rename_stage)  # from an interrupted run
+    os.makedirs(rename_stage, exist_ok=True)
+    rename_possible = same_filesystem(rename_stage, TARGET)
+    if (strategy != "rename" or not rename_possible) and not leftover:
+        os.rmdir(rename_stage)
+    link_possible = same_filesystem(TMP, MASTERS)
+
+    if strategy == "auto":
+        if rename_possible:
+            strategy = "rename"
+        elif link_possible:
+            strategy = "link"
+        else:
+            strategy = "manifest"
+    elif strategy == "rename" and not rename_possible:
+        log("Staging strategy rename requires " + rename_stage + " to be on the same file system as the target", "error")
+    elif strategy == "link" and not link_possible:
+        log("Staging strategy link requires " + TMP + " to be on the same file system as the library", "error")
+
+    STAGING = strategy
+    if STAGING == "rename":
+        os.makedirs(rename_stage, exist_ok=True)
+        STAGE = rename_stage
+    if VERBOSE:
+        log("Using staging strategy " + STAGING + ", staging directory is " + STAGE + ".", "info")
+
+# copy-on-write clones, if the file system supports them (FICLONE on Linux,
+# clonefile(2) on macOS)
+FICLONE = 0x40049409
+def clone_file(sourcepath, targetpath):
+    try:
+        if sys.platform.startswith("linux"):
+            import fcntl
+            with open(sourcepath, "rb") as src, open(targetpath, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        if sys.platform == "darwin":
+            libc = ctypes.CDLL(None, use_errno=True)
+            return libc.clonefile(os.fsencode(sourcepath), os.fsencode(targetpath), 0) == 0
+    except (OSError, AttributeError):
+        pass
+    return False
+
+def copy_file(sourcepath, targetpath):
+    """
+    Copies the contents of a file, preferably within the kernel
+    (copy_file_range(2) or sendfile(2) on Linux, fcopyfile(3) on macOS via
+    shutil), otherwise using a large buffer. Returns the number of bytes copied.
+    """
+    if not hasattr(os, "copy_file_range") and not sys.platform.startswith("linux"):
+        shutil.copyfile(sourcepath, targetpath)
+        return os.path.getsize(targetpath)
+
+    with open(sourcepath, "rb") as src, open(targetpath, "wb") as dst:
+        infd = src.fileno()
+        outfd = dst.fileno()
+        size = os.fstat(infd).st_size
+
+        # large videos are read front to back exactly once
+        if size >= LARGE_FILE_THRESHOLD and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(infd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        # both syscalls advance the file offsets, so after a failure (e.g. when
+        # copying across file systems on older kernels) the next method can
+        # just pick up where the previous one left off
+        copied = 0
+        for syscall in [getattr(os, "copy_file_range", None), os.sendfile]:
+            if syscall is None:
+                continue
+            try:
+                while copied < size:
+                    if syscall is os.sendfile:
+                        n = os.sendfile(outfd, infd, None, size - copied)
+                    else:
+                        n = syscall(infd, outfd, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
+            if copied >= size:
+                return copied
+
+        buf = bytearray(COPY_BUFFER_SIZE)
+        view = memoryview(buf)
+        while True:
+            n = src.readinto(buf)
+            if not n:
+                break
+            dst.write(view[:n])
+            copied += n
+        return copied
+
+def clone_or_copy(sourcepath, targetpath):
+    if not clone_file(sourcepath, targetpath):
+        copy_file(sourcepath, targetpath)
+
+# Journal of completed units of work – staging a file, converting a HEIC file,
+# persisting a file to the TARGET – kept in the staging directory (which, along
+# with the journal, survives interrupted or aborted runs, see clean_up), such
+# that a rerun only needs to redo what's missing. One JSON object per line, each
+# with the unit's output path relative to STAGE, the identity of its source file
+# (size and modification time), and the size and a checksum of its output.
+JOURNAL = None
+JOURNAL_LOCK = threading.Lock()
+
+# Valid entries of the journal of a previous run (the latest entry for each path
+# wins), for staged or converted files and for persisted ones, respectively.
+STAGED = {}
+PERSISTED = {}
+
+# Bytes read from the start and end of a file for its checksum (see checksum).
+CHECKSUM_SAMPLE_SIZE = 64 * 1024
+
+def identity(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def checksum(path):
+    """
+    Checksum of a file's size, start and end – catches truncated and partially
+    written files without having to read all of them.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(str(size).encode())
+        h.update(f.read(CHECKSUM_SAMPLE_SIZE))
+        if size > CHECKSUM_SAMPLE_SIZE:
+            f.seek(max(CHECKSUM_SAMPLE_SIZE, size - CHECKSUM_SAMPLE_SIZE))
+            h.update(f.read(CHECKSUM_SAMPLE_SIZE))
+    return h.hexdigest()
+
+def full_checksum(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def open_journal():
+    global JOURNAL
+    path = os.path.join(STAGE, ".apple-photos-export-journal")
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn write at the time of a crash
+                if entry["unit"] == "persist":
+                    PERSISTED[entry["path"]] = entry
+                else:
+                    STAGED[entry["path"]] = entry
+        log("Found journal of a previous run with " + str(len(STAGED)) + " staged and " + str(len(PERSISTED)) + " persisted files, will only redo what's missing.", "info")
+    JOURNAL = open(path, "a")
+
+def close_journal():
+    global JOURNAL
+    if JOURNAL is not None:
+        with JOURNAL_LOCK:
+            JOURNAL.flush()
+            os.fsync(JOURNAL.fileno())
+            JOURNAL.close()
+            JOURNAL = None
+
+def journal(unit, path, sourcepath, outpath=None):
+    """
+    Records that the unit of work producing path (within STAGE) from sourcepath
+    has been completed, with its output at outpath (defaults to path).
+    """
+    entry = {
+        "unit": unit,
+        "path": os.path.relpath(path, STAGE),
+        "source": identity(sourcepath),
+        "size": os.path.getsize(outpath or path),
+        "checksum": checksum(outpath or path)
+    }
+    with JOURNAL_LOCK:
+        JOURNAL.write(json.dumps(entry) + "\n")
+        JOURNAL.flush()
+
+def intact(path, entry):
     try:
-        subprocess.check_output(["sips", "-s", "format", "jpeg", "-s", "formatOptions", str(quality), heicfile, "--out", jpegfile])
-    except subprocess.CalledProcessError as err:
-        log("sips failed: " + repr(err), "error")
+        return os.path.getsize(path) == entry["size"] and checksum(path) == entry["checksum"]
+    except OSError:
+        return False
+
+def persisted(path, sourcepath=None):
+    """
+    Whether the staged file at path has already been persisted to the TARGET in
+    a previous run, unchanged since (or, in the manifest strategy, straight from
+    the unchanged sourcepath – JPEG versions are staged even then, and come
+    without one).
+    """
+    rel = os.path.relpath(path, STAGE)
+    entry = PERSISTED.get(rel)
+    if entry is None:
+        return False
+    if STAGING == "manifest" and sourcepath is not None:
+        try:
+            unchanged = entry["source"] == identity(sourcepath)
+        except OSError:
+            return False
+    else:
+        unchanged = rel in STAGED and STAGED[rel]["checksum"] == entry["checksum"]
+    return unchanged and intact(os.path.join(TARGET, rel), entry)
+
+def already_done(path, sourcepath):
+    """
+    Whether a previous run has already staged (or converted) sourcepath to path,
+    and the result is still intact in the staging directory or the TARGET.
+    """
+    entry = STAGED.get(os.path.relpath(path, STAGE))
+    if entry is None or entry["source"] != identity(sourcepath):
+        return False
+    return intact(path, entry) or persisted(path)
+
+def stage_file(sourcepath, stagedpath):
+    """
+    Returns the TMP_FILES entry for the staged file, or None if it's already in
+    the TARGET (see in_target).
+    """
+    if in_target(sourcepath, os.path.join(TARGET, os.path.relpath(stagedpath, STAGE))):
+        return None
+    if STAGING == "manifest":
+        return (stagedpath, sourcepath)
+    if already_done(stagedpath, sourcepath):
+        count("resumed")
+        return (stagedpath, None)
+    # rather than write into what's left of a previous run, which may be a
+    # hardlink to the master itself (see the link strategy)
+    if os.path.lexists(stagedpath):
+        os.remove(stagedpath)
+    if STAGING == "link":
+        os.link(sourcepath, stagedpath)
+    else:
+        clone_or_copy(sourcepath, stagedpath)
+        st = os.stat(sourcepath)
+        os.utime(stagedpath, ns=(st.st_atime_ns, st.st_mtime_ns))  # for same_content
+        count("bytes", st.st_size)
+    journal("stage", stagedpath, sourcepath)
+    count("files")
+    return (stagedpath, None)
 
 def export_file(sourcepath, prefix):
+    """
+    Stages a file (and queues the creation of a JPEG version if it's a HEIC
+    image), returning the TMP_FILES entries to be logged. Files already in the
+    TARGET are skipped, and so are their JPEG versions if those have been
+    exported along with them.
+    """
 
     # create intermediate directories if required
     directory = os.path.dirname(prefix)
     os.makedirs(directory, exist_ok=True)
 
-    # copy file
+    # a master with several versions comes up once per version, but is only
+    # staged (and logged) once
     name, ext = os.path.splitext(os.path.basename(sourcepath))
     targetpath = prefix + name + ext.lower()
-    shutil.copyfile(sourcepath, targetpath)
-    log_file(targetpath)
+    if targetpath in SOURCES:
+        return []
 
-    # create jpeg version of heic images
+    # stage file
+    entry = stage_file(sourcepath, targetpath)
+    entries = [entry] if entry else []
+    SOURCES[targetpath] = sourcepath
+
+    # create jpeg version of heic images (in the background, see
+    # finish_conversions)
     if "HEIC" in ext:
         targetjpegpath = prefix + name + ".jpg"
-        jpeg_from_heic(sourcepath, targetjpegpath)
-        log_file(targetjpegpath)
-
+        SOURCES[targetjpegpath] = sourcepath
+        if entry is not None or not jpeg_in_target(sourcepath, os.path.join(TARGET, os.path.relpath(targetjpegpath, STAGE))):
+            convert_later(sourcepath, targetjpegpath)
+            entries.append((targetjpegpath, None))
+    return entries
+
+def device_name(path):
+    dev = os.stat(path).st_dev
+    return str(os.major(dev)) + ":" + str(os.minor(dev))
+
+def index_contents(paths):
+    """
+    Adds files in the TARGET to the contents index (or refreshes the entries of
+    files changed since), with their checksums left to be computed once needed
+    (see deduplicate).
+    """
+    entries = []
+    for path in paths:
+        try:
+            entries.append((os.path.relpath(path, TARGET), *identity(path)))
+        except OSError:
+            pass
+    with STATE_LOCK, STATE:
+        STATE.executemany("""INSERT INTO contents (path, size, mtime_ns, partial, full) VALUES (?, ?, ?, NULL, NULL)
+                             ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, partial = NULL, full = NULL
+                             WHERE size != excluded.size OR mtime_ns != excluded.mtime_ns""", entries)
+
+@phase("scan_target")
+def scan_target():
+    """
+    Lists the (size, mtime_ns) of each file in the year/month tree of the
+    TARGET into TARGET_FILES, keyed by path, listing each directory once.
+    """
+    existing = TARGET_FILES
+    existing.clear()
+    with os.scandir(TARGET) as years:
+        for year in years:
+            if not (year.name.isdigit() and year.is_dir(follow_symlinks=False)):
+                continue
+            with os.scandir(year.path) as months:
+                for month in months:
+                    if not month.is_dir(follow_symlinks=False):
+                        continue
+                    with os.scandir(month.path) as files:
+                        for f in files:
+                            if f.is_file(follow_symlinks=False):
+                                st = f.stat(follow_symlinks=False)
+                                existing[f.path] = (st.st_size, st.st_mtime_ns)
+
+def index_target(existing):
+    """
+    Seeds the contents index with the files already in the TARGET (as returned
+    by scan_target) the first time deduplication is enabled – afterwards, it's
+    kept up to date by persist_files_to_target.
+    """
+    with STATE_LOCK:
+        if STATE.execute("SELECT 1 FROM settings WHERE key = 'contents_indexed'").fetchone():
+            return
+    log("Indexing files already in the target for deduplication...", "info")
+    with STATE_LOCK, STATE:
+        STATE.executemany("INSERT OR REPLACE INTO contents (path, size, mtime_ns, partial, full) VALUES (?, ?, ?, NULL, NULL)",
+                          ((os.path.relpath(path, TARGET), size, mtime_ns) for path, (size, mtime_ns) in existing.items()))
+        STATE.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('contents_indexed', ?)", (str(RUN_ID),))
+
+def same_content(sourcepath, targetpath, existing):
+    """
+    Whether the file at targetpath (as returned by scan_target) has the same
+    content as sourcepath, judging by size and modification time (which
+    persisting preserves) or, failing that, by checksums.
+    """
+    size, mtime_ns = existing[targetpath]
+    st = os.stat(sourcepath)
+    if st.st_size != size:
+        return False
+    if st.st_mtime_ns == mtime_ns:
+        return True
+    return checksum(sourcepath) == checksum(targetpath) and full_checksum(sourcepath) == full_checksum(targetpath)
+
+def conflict_path(sourcepath, targetpath):
+    # named after the content, such that reruns recognize it
+    name, ext = os.path.splitext(targetpath)
+    return name + "_conflict_" + full_checksum(sourcepath)[:8] + ext
+
+def in_target(sourcepath, targetpath):
+    """
+    Whether sourcepath is already in the TARGET at targetpath (or, if a
+    different file is in the way, under its conflict_path), in which case it
+    needn't be staged at all.
+    """
+    if targetpath not in TARGET_FILES:
+        return False
+    if not same_content(sourcepath, targetpath, TARGET_FILES):
+        targetpath = conflict_path(sourcepath, targetpath)
+        if targetpath not in TARGET_FILES or not same_content(sourcepath, targetpath, TARGET_FILES):
+            return False
+    IDENTICAL.append(targetpath)
+    count("identical")
+    return True
+
+def jpeg_in_target(heicfile, targetpath):
+    """
+    Whether the JPEG version of heicfile is already in the TARGET at
+    targetpath, judging by the exported files of previous runs or, failing
+    that, by the cached JPEG version (see cached_derivative).
+    """
+    if targetpath not in TARGET_FILES:
+        return False
+    with STATE_LOCK:
+        row = STATE.execute("SELECT source FROM exported_files WHERE path = ?", (os.path.relpath(targetpath, TARGET),)).fetchone()
+    if not (row is not None and row[0] == heicfile):
+        cached = derivative_path(heicfile)
+        if DERIVATIVE_CACHE_SIZE <= 0 or not os.path.isfile(cached) or not same_content(cached, targetpath, TARGET_FILES):
+            return False
+    IDENTICAL.append(targetpath)
+    count("identical")
+    return True
+
+def classify_writes(files, existing):
+    """
+    Sorts (source path, target path) tuples of files about to be persisted into
+    those to be written and those already in the TARGET (see same_content).
+    Files conflicting with a different file of the same name are written under
+    another name instead (see conflict_path) – they're additionally returned as
+    (source path, target path, alternative target path) tuples. Most files
+    already in the TARGET don't even get here (see in_target), but e.g. JPEG
+    versions do.
+    """
+    writes = []
+    identical = []
+    conflicts = []
+    for sourcepath, targetpath in files:
+        if targetpath not in existing:
+            writes.append((sourcepath, targetpath))
+        elif same_content(sourcepath, targetpath, existing):
+            identical.append((sourcepath, targetpath))
+        else:
+            alternative = conflict_path(sourcepath, targetpath)
+            conflicts.append((sourcepath, targetpath, alternative))
+            if alternative in existing and same_content(sourcepath, alternative, existing):
+                identical.append((sourcepath, alternative))
+            else:
+                writes.append((sourcepath, alternative))
+    return writes, identical, conflicts
+
+def deduplicate(files):
+    """
+    Splits (source path, target path) tuples of files about to be persisted
+    into those whose content isn't in the TARGET yet and (source path, target
+    path, existing path) tuples of duplicates, whether of files exported by
+    earlier runs or of files earlier in the list. Candidates are narrowed down
+    by size, then by checksum (of size, start and end), and only then compared
+    by a hash of their full contents – checksums of files in the TARGET are
+    computed once needed and kept in the contents index.
+    """
+    unique = []
+    duplicates = []
+    planned = {}  # size -> [(source path, target path)] of unique files
+    seen = set()  # target paths
+    digests = {}  # (path, kind) -> checksum of files about to be persisted
+
+    def digest(path, kind):
+        if (path, kind) not in digests:
+            digests[(path, kind)] = checksum(path) if kind == "partial" else full_checksum(path)
+        return digests[(path, kind)]
+
+    for sourcepath, targetpath in files:
+
+        # a file listed twice is persisted once, rather than as a duplicate of
+        # itself (the index doesn't list it as a candidate either)
+        if targetpath in seen:
+            continue
+        seen.add(targetpath)
+
+        size = os.path.getsize(sourcepath)
+        with STATE_LOCK:
+            candidates = STATE.execute("SELECT path, mtime_ns, partial, full FROM contents WHERE size = ? AND path != ?",
+                                       (size, os.path.relpath(targetpath, TARGET))).fetchall()
+
+        original = None
+        for path, mtime_ns, partial, full in candidates:
+            existingpath = os.path.join(TARGET, path)
+            try:
+                if identity(existingpath) != [size, mtime_ns]:
+                    index_contents([existingpath])
+                    continue
+                if partial is None:
+                    partial = checksum(existingpath)
+                if partial == digest(sourcepath, "partial") and full is None:
+                    full = full_checksum(existingpath)
+            except OSError:
+                with STATE_LOCK, STATE:
+                    STATE.execute("DELETE FROM contents WHERE path = ?", (path,))
+                continue
+            with STATE_LOCK, STATE:
+                STATE.execute("UPDATE contents SET partial = ?, full = ? WHERE path = ?", (partial, full, path))
+            if full is not None and full == digest(sourcepath, "full"):
+                original = existingpath
+                break
+
+        if original is None:
+            for othersourcepath, othertargetpath in planned.get(size, []):
+                if digest(othersourcepath, "partial") == digest(sourcepath, "partial") \
+                        and digest(othersourcepath, "full") == digest(sourcepath, "full"):
+                    original = othertargetpath
+                    break
+
+        if original is None:
+            unique.append((sourcepath, targetpath))
+            planned.setdefault(size, []).append((sourcepath, targetpath))
+        else:
+            duplicates.append((sourcepath, targetpath, original))
+    return unique, duplicates
+
+@phase("persist_files_to_target")
 def persist_files_to_target():
     log("Persisting exported media files to target...")
-    progress(0, len(TMP_FILES))
-    for i, tmppath in enumerate(TMP_FILES):
-        rel = os.path.relpath(tmppath, TMP)
+
+    # plan all moves and copies first, creating each directory only once
+    # (skipping what's been persisted by a previous, interrupted run)
+    files = []
+    directories = set()
+    skipped = []
+    for tmppath, sourcepath in TMP_FILES:
+        rel = os.path.relpath(tmppath, STAGE)
         targetpath = os.path.join(TARGET, rel)
-        directory = os.path.dirname(targetpath)
+        if persisted(tmppath, sourcepath):
+            skipped.append(targetpath)
+            continue
+        directories.add(os.path.dirname(targetpath))
+        files.append((sourcepath or tmppath, targetpath))
+    for directory in directories:
         os.makedirs(directory, exist_ok=True)
-        shutil.copyfile(tmppath, targetpath)
-        # TODO log("The file" + targetpath + " already existed, I overwrote it, "warn")
-        progress(i+1, len(TMP_FILES), os.path.basename(tmppath))
+
+    if skipped:
+        log("Skipping " + str(len(skipped)) + " files already persisted by a previous run.", "info")
+        count("resumed", len(skipped))
+
+    # skip files that are already in the target (on top of those skipped while
+    # exporting) and make sure nothing gets overwritten
+    existing = TARGET_FILES
+    files, identical, conflicts = classify_writes(files, existing)
+    count("identical", len(identical))
+    identical = IDENTICAL + [targetpath for _, targetpath in identical]
+    if identical:
+        log("Skipping " + str(len(identical)) + " files identical to ones already in the target.", "info")
+    writes = set(targetpath for _, targetpath in files)
+    for sourcepath, targetpath, alternative in conflicts:
+        if alternative in writes:  # rather than already written by an earlier run
+            log("The file " + targetpath + " already exists with different content, will keep it and write " + os.path.basename(alternative) + " instead", "warn")
+        CONFLICTS.append({"path": os.path.relpath(targetpath, TARGET), "written_to": os.path.relpath(alternative, TARGET)})
+        count("conflicts")
+
+    # leave out files whose content is already in the target under another name
+    # (or will be, once an earlier file has been persisted)
+    duplicates = []
+    if DEDUPLICATION != "off":
+        if DEDUPLICATION not in ["link", "skip"]:
+            log("Unknown deduplication mode " + DEDUPLICATION + " (should be one of: link, skip, off)", "error")
+        index_target(existing)
+        index_contents(skipped + identical)  # in case the previous run didn't get to it
+        files, duplicates = deduplicate(files)
+        if duplicates:
+            log("Found " + str(len(duplicates)) + " files whose content has already been exported, will " + ("hardlink" if DEDUPLICATION == "link" else "skip") + " them (see report).", "info")
+
+    renames = []
+    copies = []
+    for frompath, targetpath in files:
+        if STAGING == "rename":
+            renames.append((frompath, targetpath))
+        else:
+            copies.append((frompath, targetpath))
+
+    total = len(files) + len(duplicates)
+    done = 0
+    progress(done, total)
+
+    for tmppath, targetpath in renames:
+        os.replace(tmppath, targetpath)
+        journal("persist", tmppath, targetpath, targetpath)
+        count("files")
+        done += 1
+        progress(done, total, os.path.basename(tmppath))
+
+    # copy large and small files in separate pools, large ones first since
+    # they'll take longest
+    throughput = {}  # (source device, target device) -> [bytes, start, end]
+    def copy(sourcepath, targetpath):
+        start = time.perf_counter()
+        copied = copy_file(sourcepath, targetpath)
+        st = os.stat(sourcepath)
+        os.utime(targetpath, ns=(st.st_atime_ns, st.st_mtime_ns))  # for same_content
+        end = time.perf_counter()
+        journal("persist", os.path.join(STAGE, os.path.relpath(targetpath, TARGET)), sourcepath, targetpath)
+        count("files")
+        count("bytes", copied)
+        key = device_name(sourcepath) + " -> " + device_name(targetpath)
+        with copy.lock:
+            stats = throughput.setdefault(key, [0, start, end])
+            stats[0] += copied
+            stats[1] = min(stats[1], start)
+            stats[2] = max(stats[2], end)
+        return sourcepath
+    copy.lock = threading.Lock()
+
+    copies = [(os.path.getsize(sourcepath), sourcepath, targetpath) for sourcepath, targetpath in copies]
+    copies.sort(key=lambda c: -c[0])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, COPY_WORKERS_LARGE)) as large_pool, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=max(1, COPY_WORKERS_SMALL)) as small_pool:
+        futures = []
+        for size, sourcepath, targetpath in copies:
+            pool = large_pool if size >= LARGE_FILE_THRESHOLD else small_pool
+            futures.append(pool.submit(copy, sourcepath, targetpath))
+        for future in concurrent.futures.as_completed(futures):
+            sourcepath = future.result()
+            done += 1
+            progress(done, total, os.path.basename(sourcepath))
+
+    # hardlink duplicates to the files already holding their content (or copy
+    # them after all if the target's file system doesn't do hardlinks)
+    left_out = set()
+    for sourcepath, targetpath, original in duplicates:
+        DUPLICATES.append({"path": os.path.relpath(targetpath, TARGET), "original": os.path.relpath(original, TARGET)})
+        count("duplicates")
+        count("duplicate_bytes", os.path.getsize(sourcepath))
+        if DEDUPLICATION == "skip":
+            left_out.add(targetpath)
+        else:
+            if os.path.lexists(targetpath):
+                os.remove(targetpath)
+            try:
+                os.link(original, targetpath)
+            except OSError:
+                copy_file(sourcepath, targetpath)
+            journal("persist", os.path.join(STAGE, os.path.relpath(targetpath, TARGET)), sourcepath, targetpath)
+            count("files")
+        done += 1
+        progress(done, total, os.path.basename(targetpath))
+
+    if DEDUPLICATION != "off":
+        index_contents(targetpath for _, targetpath in files)
+    written_to = {targetpath: alternative for _, targetpath, alternative in conflicts}
+    exported = []
+    for tmppath, sourcepath in TMP_FILES:
+        targetpath = os.path.join(TARGET, os.path.relpath(tmppath, STAGE))
+        targetpath = written_to.get(targetpath, targetpath)
+        if targetpath not in left_out:
+            exported.append((os.path.relpath(targetpath, TARGET), SOURCES.get(tmppath, sourcepath)))
+    record_exported_files(exported)
+
+    if throughput:
+        log("Copy throughput per device (source -> target):", "info")
+        table({k: str(round(b / max(end - start, 1e-6) / 1024 / 1024, 1)) + " MB/s (" + str(round(b / 1024 / 1024, 1)) + " MB)"
+               for k, (b, start, end) in throughput.items()})
+
+# Start of the run (see main), and whether it has been completed.
+RUN = {"started": None, "completed": False}
+
+# cProfile profiler of the main thread, if enabled by --profile.
+PROFILER = None
+
+def write_report():
+    """
+    Writes measurements of the run, its phases and, if profiling is enabled,
+    the profile and the top memory allocations to the TARGET.
+    """
+    report = {
+        "started": RUN["started"][0].isoformat(),
+        "completed": RUN["completed"],
+        **measurements(RUN["started"][1]),
+        "counters": COUNTERS,
+        "phases": PHASES,
+        "duplicates": DUPLICATES,
+        "conflicts": CONFLICTS
+    }
+    if PROFILER is not None:
+        PROFILER.disable()
+        PROFILER.dump_stats(os.path.join(TARGET, "apple-photos-export-profile.prof"))
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        with open(os.path.join(TARGET, "apple-photos-export-allocations.txt"), "w") as f:
+            for stat in snapshot.statistics("lineno")[:50]:
+                f.write(str(stat) + "\n")
+    with open(os.path.join(TARGET, "apple-photos-export-report.json"), "w") as f:
+        json.dump(report, f, indent=2)
 
 def clean_up():
     log("Cleaning up...")
-    log("Removing " + TMP + "...", "info")
-    if os.path.isdir(TMP):
-        shutil.rmtree(TMP)
-
+    end_run()
+    terminate_exiftool_pool()
+    close_state()
+
+def end_run():
+    """
+    Writes the report and closes or removes everything that's specific to a run,
+    leaving the exiftool pool and the export state for the next one (see watch).
+    """
+    write_report()
+    close_journal()
+    disconnect_db()
+
+    # unless the run has been completed, keep the staging directory (and with
+    # it the journal) around such that a rerun can pick up where this one left
+    # off
+    directories = set([TMP, STAGE])
+    if not RUN["completed"]:
+        directories.discard(STAGE)
+        if os.path.isfile(TMP_DB):
+            os.remove(TMP_DB)
+        log("Keeping staged files in " + STAGE + ", a rerun will pick up where this one left off.", "info")
+    for directory in directories:
+        log("Removing " + directory + "...", "info")
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+
+@phase("create_working_copy_of_photos_db")
 def create_working_copy_of_photos_db():
     os.makedirs(TMP, exist_ok=True)
-    shutil.copyfile(DATABASE, TMP_DB)
-
-def collect_photos():
-    log("Querying database for photos and live photos...")
-
-    q = """
+    if DATABASE_MODE == "copy":
+        shutil.copyfile(DATABASE, TMP_DB)
+        connect_db(TMP_DB)
+    elif DATABASE_MODE == "backup":
+        backup_database(TMP_DB)
+        connect_db(TMP_DB)
+    elif DATABASE_MODE == "reuse":
+        connect_db(reuse_or_backup_database())
+    elif DATABASE_MODE == "readonly":
+        connect_db(DATABASE, mode="ro")
+    elif DATABASE_MODE == "immutable":
+        connect_db(DATABASE, immutable=1)
+    else:
+        log("Unknown database mode " + DATABASE_MODE + " (should be one of: reuse, backup, copy, readonly, immutable)", "error")
+    if VERBOSE:
+        log("Accessing photos.db in mode " + DATABASE_MODE + ".", "info")
+
+def backup_database(path):
+    """
+    Takes a consistent snapshot of the library's database (including anything
+    still in its write-ahead log), even while Photos is writing to it.
+    """
+    source = sqlite3.connect(database_uri(DATABASE, mode="ro"), uri=True)
+    target = sqlite3.connect(path)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+def database_identity():
+    # the database along with its write-ahead log, if any
+    return [identity(p) if os.path.exists(p) else None for p in [DATABASE, DATABASE + "-wal"]]
+
+def reuse_or_backup_database():
+    """
+    Returns the path of the working copy in DB_CACHE, only taking a new snapshot
+    if the library's database has changed since the previous one.
+    """
+    path = os.path.join(DB_CACHE, "photos.db")
+    identity_path = os.path.join(DB_CACHE, "photos.db.identity")
+
+    # since the identity is determined before taking the snapshot, changes
+    # made while taking it will cause another snapshot next time
+    current = database_identity()
+    try:
+        with open(identity_path, "r") as f:
+            previous = json.load(f)
+    except (FileNotFoundError, ValueError):
+        previous = None
+    if previous == current and os.path.isfile(path):
+        log("Library's database unchanged since the previous run, reusing its working copy.", "info")
+        return path
+
+    os.makedirs(DB_CACHE, exist_ok=True)
+    backup_database(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    with open(identity_path, "w") as f:
+        json.dump(current, f)
+    return path
+
+# Number of relevant masters in the database.
+MEDIA_TOTAL = 0
+
+# Paths of relevant media that couldn't be categorized.
+UNKNOWN_MEDIA = []
+
+# Import groups of the media enumerated (see enumerate_media), which are
+# recorded as exported once the run has been completed (see write_cache).
+ENUMERATED_IMPORT_GROUPS = set()
+
+# Categories in the order of the flag columns computed by classification_query.
+# Note that categories aren't necessarily mutually exclusive.
+CATEGORIES = [
+    ("photo", IS_PHOTO),
+    ("video", IS_VIDEO),
+    ("burst", IS_BURST),
+    ("panorama", IS_PANORAMA),
+    ("square", IS_SQUARE),
+    ("insta", IS_INSTA),
+    ("screenshot", IS_SCREENSHOT),
+    ("screenrecording", IS_SCREENRECORDING),
+    ("whatsapp_photo", IS_WHATSAPP_PHOTO),
+    ("whatsapp_video", IS_WHATSAPP_VIDEO)
+]
+
+def classification_query():
+    # single scan over RKMaster, computing a flag per category – versions are
+    # only joined for photos and attachments only for videos, which yields the
+    # same rows as separate per-category queries would
+    return """
         SELECT m.modelId AS id,
                m.imagePath AS absolutepath,
                m.fileCreationDate AS creationdate,
                m.mediaGroupId AS contentidentifier,
-               v.selfPortrait AS selfie
-        FROM RKMaster m LEFT JOIN RKVersion v ON m.uuid = v.masterUuid
-    """ + pred(IS_PHOTO, only_relevant_import_groups())
-    photos = query(q)
+               v.selfPortrait AS selfie,
+               COALESCE(v.adjustmentUuid, 'UNADJUSTEDNONRAW') != 'UNADJUSTEDNONRAW' AS edited,
+               m.burstUuid AS burstid,
+               a.filePath AS attachment,
+               a.fileModificationDate AS modificationdate,
+               COALESCE(m.importGroupUuid, '""" + NO_IMPORT_GROUP + """') AS importgroup,
+               """ + ",\n".join("(" + p + ") AS is_" + c for c, p in CATEGORIES) + """
+        FROM RKMaster m
+             LEFT JOIN RKVersion v ON m.uuid = v.masterUuid AND (""" + IS_PHOTO + """)
+             LEFT JOIN RKAttachment a ON m.uuid = a.attachedToUuid AND (""" + IS_VIDEO + """)
+    """ + pred(only_relevant_import_groups())
 
+def count_media():
+    """
+    Returns the number of items enumerate_media will yield, and sets MEDIA_TOTAL.
+    """
+    global MEDIA_TOTAL
+    MEDIA_TOTAL, items = query(count_query())[0]
+    return int(items)
+
+def count_query():
+    flags = ["is_" + c for c, _ in CATEGORIES]
+    return ("SELECT COUNT(DISTINCT id), TOTAL(" + " + ".join("(" + f + " IS 1)" for f in flags)
+            + " + (" + " AND ".join(f + " IS 0" for f in flags) + "))"
+            + " FROM (" + classification_query() + ")")
+
+# Indexes created on the working copy of the database for the queries above, as
+# (name, table, columns) tuples: masters by import group (for only looking at
+# relevant ones), and covering indexes for the joins with versions and
+# attachments.
+WORKING_COPY_INDEXES = [
+    ("export_master_import_group", "RKMaster", ["importGroupUuid"]),
+    ("export_version_master_adjustment", "RKVersion", ["masterUuid", "selfPortrait", "adjustmentUuid"]),
+    ("export_attachment_master", "RKAttachment", ["attachedToUuid", "filePath", "fileModificationDate"])
+]
+
+@phase("prepare_database")
+def prepare_database():
+    """
+    Creates the WORKING_COPY_INDEXES (unless photos.db is accessed in place) and
+    gathers statistics for the query planner. With the "reuse" database mode,
+    this only needs to happen whenever the library's database has changed. In
+    verbose mode, the plans of the export queries are logged.
+    """
+    if DATABASE_MODE in ["readonly", "immutable"]:
+        if VERBOSE:
+            log("Not indexing photos.db since it's accessed in place.", "info")
+    else:
+        existing = set(r[0] for r in query("SELECT name FROM sqlite_master WHERE type = 'index'"))
+        missing = [i for i in WORKING_COPY_INDEXES if i[0] not in existing]
+        if missing:
+            log("Indexing working copy of database...", "info")
+            with DB:
+                for name, table, columns in missing:
+                    DB.execute("CREATE INDEX IF NOT EXISTS " + name + " ON " + table + " (" + ", ".join(columns) + ")")
+            DB.execute("ANALYZE main")
+
+    if VERBOSE:
+        for name, q in [("counting", count_query()), ("classifying", classification_query())]:
+            log("Query plan for " + name + " media:", "info")
+            depth = {0: 0}
+            for id, parent, _, detail in query("EXPLAIN QUERY PLAN " + q):
+                depth[id] = depth.get(parent, 0) + 1
+                log("  " * depth[id] + detail, "info")
+
+class Medium:
+    """
+    A relevant master, as classified by classification_query. There's one per
+    master (shared between the categories it belongs to) passing through the
+    export pipeline, so it's kept compact.
+    """
+    __slots__ = ("id", "path", "creationdate", "contentidentifier", "selfie", "edited", "burstid", "attachment", "modificationdate", "importgroup")
+
+    def __init__(self, id, path, creationdate, contentidentifier, selfie, edited, burstid, attachment, modificationdate, importgroup):
+        self.id = id
+        self.path = path
+        self.creationdate = creationdate
+        self.contentidentifier = contentidentifier
+        self.selfie = selfie
+        self.edited = edited
+        self.burstid = burstid
+        self.attachment = attachment
+        self.modificationdate = modificationdate
+        self.importgroup = importgroup
+
+def enumerate_media():
+    """
+    Yields a (category, medium) tuple for each relevant medium and each
+    category it belongs to, streaming through the database in batches, and
+    collects the ENUMERATED_IMPORT_GROUPS along the way.
+    """
+    fields = len(Medium.__slots__)
+    for row in iterquery(classification_query()):
+        medium = Medium(*row[:fields])
+        flags = row[fields:]
+        ENUMERATED_IMPORT_GROUPS.add(medium.importgroup)
+
+        # like in a WHERE clause, NULL counts as false here – and as in a
+        # conjunction of negated predicates, media only count as unknown if
+        # each predicate is actually false
+        if all(f == 0 for f in flags):
+            yield ("unknown", medium)
+            continue
+
+        for (c, _), f in zip(CATEGORIES, flags):
+            if f == 1:
+                yield (c, medium)
+
+@phase("build_live_photo_index")
+def build_live_photo_index():
     log("Completing index of live photo videos...")
-    mov_files = glob.iglob(MASTER + '/**/*.mov', recursive=True)
-    mov_files = [p for p in mov_files if p not in LIVE_PHOTO_VIDEOS.values()]
+    mov_files = scan_directory(MASTER, '*.mov')
+    with STATE_LOCK:
+        mov_files = [p for p in mov_files if not STATE.execute("SELECT 1 FROM live_photo_videos WHERE path = ?", (p,)).fetchone()]
 
     if mov_files:
-        with exif.ExifTool() as et:
-            log("Batch-extracting metadata (this might take a minute or three)...", "info")
-            metadata = et.get_metadata_batch(mov_files)
+        metadata = extract_metadata(mov_files)
 
         new_live_photo_videos = {}
         log("Looking for QuickTime:ContentIdentifier fields...", "info")
@@ -366,323 +1983,473 @@ def collect_photos():
             try:
                 new_live_photo_videos[d["QuickTime:ContentIdentifier"]] = d["SourceFile"]
             except KeyError:
-                log("Couldn't find QuickTime:ContentIdentifier field for " + d["System:FileName"] + ", will ignore", "warn")
-
-        global LIVE_PHOTO_VIDEOS
-        LIVE_PHOTO_VIDEOS = {**LIVE_PHOTO_VIDEOS, **new_live_photo_videos}
-
-    log("Matching live photos with corresponding video files...")
-    photos2 = [] # id, date, photo file, video file
-    for l in photos:
-        id = l[0]
-        photopath = MASTERS + "/" + l[1]
-        creationdate = l[2]
-        contentidentifier = l[3]
-        selfie = bool(l[4])
-        try:
-            videopath = LIVE_PHOTO_VIDEOS[contentidentifier]  # TODO could also be new_live_photo_videos?
-            photos2.append(tuple([id, photopath, creationdate, videopath, selfie]))
-        except KeyError:
-            log("Couldn't find live photo video file for " + photopath + ", will keep it without a video", "warn")
-            photos2.append(tuple([id, photopath, creationdate, None, selfie]))
-
-    # TODO get rendered variants of photos that were edited in the camera/photos app:
-    # build and match contentid index of files in resources/media/version => edited photos and corresponding edited live videos
-    # for edited photos, RKVersion.adjustmentUuid is not UNADJUSTEDNONRAW
-    # can match edited photo and edited live video based on [Apple]         ContentIdentifier               : 0ABA71EB-76B4-410E-9F82-EB42D63F4B2D
-    # and [QuickTime]     ContentIdentifier               : 0ABA71EB-76B4-410E-9F82-EB42D63F4B2D
-    # but how to match with original/raw photo? also just based on time (modificationdate, photo/video create date) like video? ugh
-    # => seems error-prone, so not gonna do this for now
-
-    log("Collecting photos and corresponding live photo video files and creating JPEG versions...")
-    progress(0, len(photos2))
-    for i, (id, photopath, creationdate, videopath, selfie) in enumerate(photos2):
-
-        # assemble filename prefix
-        filename_prefix = assemble_filename_prefix(creationdate, id)
-        if selfie:
-            filename_prefix = filename_prefix + "selfie_"
-
-        # copy photo and create jpeg version
-        export_file(photopath, filename_prefix)
-        tally("written", "Photos")
-        tally("written", "Photos as JPEG")
-
-        # copy live video if it exists
-        if videopath:
-            export_file(videopath, filename_prefix)
-            tally("written", "Live photo videos")
-
-        tally("total", "Considered")
-        progress(i+1, len(photos2), os.path.basename(photopath))
-
-def collect_videos():
-    log("Querying database for videos...")
-
-    q = """
-        SELECT m.modelId AS id,
-               m.imagePath AS absolutepath,
-               m.fileCreationDate AS creationdate,
-               a.filePath AS attachment,
-               a.fileModificationDate AS modificationdate
-        FROM RKMaster m LEFT JOIN RKAttachment a on m.uuid = a.attachedToUuid
-    """ + pred(IS_VIDEO, only_relevant_import_groups())
-    videos = query(q)
-
-    log("Building index of rendered slomo videos...")
-    rendered_slomo_videos = {}
-
-    mov_files = glob.iglob(VERSION + '/**/fullsizeoutput_*.mov', recursive=True)
-    mov_files = list(mov_files)
-    if mov_files:
-        with exif.ExifTool() as et:
-            log("Batch-extracting metadata (this might take a few seconds)...", "info")
-            metadata = et.get_metadata_batch(mov_files)
-
-        log("Looking for QuickTime:DateTimeOriginal fields...", "info")
+                log("Couldn't find QuickTime:ContentIdentifier field for " + os.path.basename(d["SourceFile"]) + ", will ignore", "warn")
+
+        with STATE_LOCK, STATE:
+            STATE.executemany("INSERT OR REPLACE INTO live_photo_videos (contentidentifier, path) VALUES (?, ?)",
+                              new_live_photo_videos.items())
+
+# Kinds of rendered versions in resources/media/version, as (kind, filename
+# pattern, tag they're matched by) tuples: slomo videos actually rendered as
+# slomos are matched with slomo videos by date (there's nothing else to go on),
+# while edited photos and the edited live photo videos rendered along with them
+# have the same content identifier as the original photo.
+VERSION_KINDS = [
+    ("slomo", "fullsizeoutput_*.mov", "QuickTime:DateTimeOriginal"),
+    ("photo", "fullsizeoutput_*.jpeg", "Apple:ContentIdentifier"),
+    ("live", "videocomplementoutput_*.mov", "QuickTime:ContentIdentifier")
+]
+
+def version_kind(path):
+    name = os.path.basename(path)
+    for kind, pattern, tag in VERSION_KINDS:
+        if fnmatch.fnmatchcase(name, pattern):
+            return kind, tag
+
+@phase("build_version_index")
+def build_version_index():
+    """
+    Indexes all rendered versions in a single pass over resources/media/version,
+    i.e. one directory scan and one exiftool run for rendered slomos, edited
+    photos and edited live photo videos alike, and matches them with the masters
+    (see RENDERED_SLOMOS and EDITED_VERSIONS).
+    """
+    global RENDERED_SLOMOS
+    global EDITED_VERSIONS
+
+    log("Building index of rendered slomo videos and edited photos...")
+    rendered_versions = []
+
+    files = scan_directory(VERSION, *(pattern for _, pattern, _ in VERSION_KINDS))
+    if files:
+        metadata = extract_metadata(files, fast=EXIFTOOL_FAST_VERSIONS)
+
+        log("Looking for QuickTime:DateTimeOriginal and Apple/QuickTime:ContentIdentifier fields...", "info")
         for d in metadata:
+            kind, tag = version_kind(d["SourceFile"])
             try:
-                modificationdate = d["QuickTime:DateTimeOriginal"]
-                modificationdate_tz = int(datetime.strptime(modificationdate, "%Y:%m:%d %H:%M:%S%z").timestamp())
-                rendered_slomo_videos[modificationdate_tz] = d["SourceFile"]
+                if kind == "slomo":
+                    modificationdate = d[tag]
+                    modificationdate_tz = int(datetime.strptime(modificationdate, "%Y:%m:%d %H:%M:%S%z").timestamp())
+                    rendered_versions.append((d["SourceFile"], kind, None, modificationdate_tz))
+                else:
+                    rendered_versions.append((d["SourceFile"], kind, d[tag], None))
             except KeyError:
-                log("Couldn't find QuickTime:DateTimeOriginal field for " + d["System:FileName"] + ", will ignore", "warn")
-
-    log("Matching slomo videos with corresponding rendered slomo videos...")
-    videos2 = [] # id, date, video file, rendered slomo file
-    for l in videos:
-        id = l[0]
-        videopath = MASTERS + "/" + l[1]
-        creationdate = l[2]
-        attachment = l[3]
-        modificationdate = l[4]
-        try:
-            renderedslomopath = rendered_slomo_videos[weird_apple_timestamp_to_unix(modificationdate)]
-            videos2.append(tuple([id, videopath, creationdate, renderedslomopath]))
-        except (KeyError, TypeError):
-            if attachment:  # only in this case we expect a rendered slomo  # TODO move this predicate up
-                log("Couldn't find rendered slomo video for " + videopath + ", will keep it without one", "warn")
-            videos2.append(tuple([id, videopath, creationdate, None]))
-
-    log("Collecting videos: normal videos, timelapses, slomos (real-time, high-framerate versions) and rendered slomo videos...")
-
-    # TODO timelapses: framerate 30 (instead of ~60 vs. ~240) and also: [Track1]        ComApplePhotosCaptureMode       : Time-lapse
-
-    progress(0, len(videos2))
-    for i, (id, videopath, creationdate, renderedslomopath) in enumerate(videos2):
-
-        # assemble filename prefix
-        filename_prefix = assemble_filename_prefix(creationdate, id)
-        if renderedslomopath:
-            filename_prefix = filename_prefix + "slomo_"
-
-        # copy video
-        export_file(videopath, filename_prefix)
-        tally("written", "Videos")
-
-        # copy rendered slomo video if it exists
-        if renderedslomopath:
-            export_file(renderedslomopath, filename_prefix + "rendered_")
-            tally("written", "Rendered slomos")
-
-        tally("total", "Considered")
-        progress(i+1, len(videos2), os.path.basename(videopath))
-
-def collect_bursts():
-    log("Querying database for burst photos...")
+                log("Couldn't find " + tag + " field for " + os.path.basename(d["SourceFile"]) + ", will ignore", "warn")
 
-    q = """
-        SELECT m.modelId AS id,
-               m.imagePath AS absolutepath,
-               m.fileCreationDate AS creationdate,
-               m.burstUuid AS burstid
-        FROM RKMaster m
-    """ + pred(IS_BURST, only_relevant_import_groups())
-    bursts = query(q)
-
-    # TODO RKVersion contains column burstPickType indicating (weirdly?) which image was chosen as the "hero" image
-
-    log("Collecting burst photos...")
-    progress(0, len(bursts))
-    for i, l in enumerate(bursts):
-        id = l[0]
-        burstpath = MASTERS + "/" + l[1]
-        creationdate = l[2]
-        burstid = l[3]
-
-        # assemble filename prefix
-        filename_prefix = assemble_filename_prefix(creationdate, id) + "burst_" + burstid + "_"
-
-        # copy photo
-        export_file(burstpath, filename_prefix)
-        tally("written", "Burst mode photos")
-
-        tally("total", "Considered")
-        progress(i+1, len(bursts), os.path.basename(burstpath))
-
-def collect_panoramas():
-    log("Querying database for panoramas...")
+    # a photo edited more than once may have left several rendered versions
+    # behind, in which case the most recent one is what Photos shows
+    edited_versions = [(path, kind, contentidentifier) for path, kind, contentidentifier, _ in rendered_versions if kind != "slomo"]
+    EDITED_VERSIONS = {}
+    for path, kind, contentidentifier in sorted(edited_versions, key=lambda v: os.path.getmtime(v[0])):
+        EDITED_VERSIONS[(kind, contentidentifier)] = path
 
+    # match all slomos at once, by the modification dates of their attachments
+    index = TemporalIndex((timestamp, path) for path, kind, _, timestamp in rendered_versions if kind == "slomo")
     q = """
-        SELECT m.modelId AS id,
-               m.imagePath AS absolutepath,
-               m.fileCreationDate AS creationdate
-        FROM RKMaster m
-    """ + pred(IS_PANORAMA, only_relevant_import_groups())
-    panoramas = query(q)
-
-    log("Collecting panoramas and creating JPEG versions...")
-    progress(0, len(panoramas))
-    for i, l in enumerate(panoramas):
-        id = l[0]
-        panoramapath = MASTERS + "/" + l[1]
-        creationdate = l[2]
-
-        # assemble filename prefix  # TODO abstract this
-        filename_prefix = assemble_filename_prefix(creationdate, id) + "panorama_"
-
-        # copy photo and create jpeg version
-        export_file(panoramapath, filename_prefix)
-        tally("written", "Panoramas")
-        tally("written", "Panoramas as JPEG")
-
-        tally("total", "Considered")
-        progress(i+1, len(panoramas), os.path.basename(panoramapath))
-
-def collect_squares():
-    log("Querying database for square photos...")
-
-    q = """
-        SELECT m.modelId AS id,
-               m.imagePath AS absolutepath,
-               m.fileCreationDate AS creationdate
-        FROM RKMaster m
-    """ + pred(IS_SQUARE, only_relevant_import_groups())
-    squares = query(q)
-
-    log("Collecting square photos and creating JPEG versions...")
-    progress(0, len(squares))
-    for i, l in enumerate(squares):
-        id = l[0]
-        squarepath = MASTERS + "/" + l[1]
-        creationdate = l[2]
-
-        # assemble filename prefix  # TODO abstract this
-        filename_prefix = assemble_filename_prefix(creationdate, id) + "square_"
-
-        # copy photo and create jpeg version
-        export_file(squarepath, filename_prefix)
-        tally("written", "Square photos")
-        tally("written", "Square photos as JPEG")
-
-        tally("total", "Considered")
-        progress(i+1, len(squares), os.path.basename(squarepath))
-
-def collect_insta_photos():
-    log("Querying database for Instagram photos...")
-
-    q = """
-        SELECT m.modelId AS id,
-               m.imagePath AS absolutepath,
-               m.fileCreationDate AS creationdate
-        FROM RKMaster m
-    """ + pred(IS_INSTA, only_relevant_import_groups())
-    instas = query(q)
+        SELECT DISTINCT a.fileModificationDate
+        FROM RKMaster m JOIN RKAttachment a ON m.uuid = a.attachedToUuid
+    """ + pred(IS_VIDEO, only_relevant_import_groups(), "a.fileModificationDate IS NOT NULL")
+    modificationdates = [r[0] for r in query(q)]
+    matches = index.match_all([weird_apple_timestamp_to_unix(d) for d in modificationdates], RENDERED_SLOMO_TOLERANCE)
+    RENDERED_SLOMOS = {d: matches[weird_apple_timestamp_to_unix(d)] for d in modificationdates}
+
+# Rendered slomos matched with the modification dates of slomo videos'
+# attachments, as (path, ambiguous) tuples (see build_version_index).
+RENDERED_SLOMOS = {}
+
+# Rendered versions of edited photos, keyed by ("photo", content identifier),
+# and the edited live photo videos rendered along with them, keyed by ("live",
+# content identifier) (see build_version_index).
+EDITED_VERSIONS = {}
+
+# Futures of the indexes needed for matching photos with live photo videos and
+# edited versions, and videos with rendered slomos, built in the background
+# while the database is being queried (see export_media).
+INDEXES = {}
+
+# The plan_* functions determine what needs to be exported for a Medium of the
+# respective category: they return a list of (source path, filename prefix)
+# tuples, a list of tallies, a list of warnings and the item's path (for the
+# progress bar).
+
+def retryable_warning(medium, warnings, warning):
+    """
+    Adds a warning that may clear up once Photos is done with medium (e.g.
+    rendering an edit), counting it for watch's retries if medium is about to
+    be recorded as exported – other warnings would come up on every retry.
+    """
+    warnings.append(warning)
+    if SETTLED_IMPORT_GROUPS is None or medium.importgroup in SETTLED_IMPORT_GROUPS:
+        count("retryable_warnings")
+
+def plan_photo(medium):
+    photopath = MASTERS + "/" + medium.path
+    exports = []
+    tallies = []
+    warnings = []
+
+    # assemble filename prefix
+    filename_prefix = assemble_filename_prefix(medium.creationdate, medium.id)
+    if medium.selfie:
+        filename_prefix = filename_prefix + "selfie_"
+
+    # photo (a jpeg version is created along the way)
+    exports.append((photopath, filename_prefix))
+    tallies.append(("written", "Photos"))
+    tallies.append(("written", "Photos as JPEG"))
+
+    # live video if it exists
+    INDEXES["live"].result()
+    videopath = live_photo_video(medium.contentidentifier)
+    if videopath:
+        exports.append((videopath, filename_prefix))
+        tallies.append(("written", "Live photo videos"))
+    else:
+        warnings.append("Couldn't find live photo video file for " + photopath + ", will keep it without a video")
+
+    # rendered versions if the photo has been edited – they're matched by the
+    # content identifier, which photos only recognized as such by their
+    # grouping UUID don't have, so there's nothing to go on for those
+    if medium.edited and medium.contentidentifier is None:
+        tallies.append(("ignored", "Edits of photos without content identifier"))
+    elif medium.edited:
+        INDEXES["version"].result()
+        editedpath = EDITED_VERSIONS.get(("photo", medium.contentidentifier))
+        if editedpath:
+            exports.append((editedpath, filename_prefix + "edited_"))
+            tallies.append(("written", "Edited photos"))
+        else:
+            retryable_warning(medium, warnings, "Couldn't find edited version of " + photopath + ", will keep only the original")
+        editedvideopath = EDITED_VERSIONS.get(("live", medium.contentidentifier))
+        if editedvideopath:
+            exports.append((editedvideopath, filename_prefix + "edited_"))
+            tallies.append(("written", "Edited live photo videos"))
+
+    tallies.append(("total", "Considered"))
+    return exports, tallies, warnings, photopath
+
+def plan_video(medium):
+    videopath = MASTERS + "/" + medium.path
+    exports = []
+    tallies = []
+    warnings = []
 
-    log("Collecting Instagram photos...")
-    progress(0, len(instas))
-    for i, l in enumerate(instas):
-        id = l[0]
-        instapath = MASTERS + "/" + l[1]
-        creationdate = l[2]
+    # TODO timelapses: framerate 30 (instead of ~60 vs. ~240) and also: [Track1]        ComApplePhotosCaptureMode       : Time-lapse
 
-        # assemble filename prefix
-        filename_prefix = assemble_filename_prefix(creationdate, id) + "instagram_"
+    INDEXES["version"].result()
+    renderedslomopath, ambiguous = RENDERED_SLOMOS.get(medium.modificationdate, (None, False))
+    if not renderedslomopath and medium.attachment:  # only in this case we expect a rendered slomo  # TODO move this predicate up
+        retryable_warning(medium, warnings, "Couldn't find rendered slomo video for " + videopath + ", will keep it without one")
+    if ambiguous:
+        warnings.append("Found several rendered slomo videos for " + videopath + " within " + str(RENDERED_SLOMO_TOLERANCE) + " seconds, will use the closest one, " + os.path.basename(renderedslomopath))
 
-        # copy photo
-        export_file(instapath, filename_prefix)
-        tally("written", "Instagrammed photos")
+    # assemble filename prefix
+    filename_prefix = assemble_filename_prefix(medium.creationdate, medium.id)
+    if renderedslomopath:
+        filename_prefix = filename_prefix + "slomo_"
 
-        tally("total", "Considered")
-        progress(i+1, len(instas), os.path.basename(instapath))
+    # video
+    exports.append((videopath, filename_prefix))
+    tallies.append(("written", "Videos"))
 
-        # TODO figure out how to get actual date? is that even possible? => from original file creation/edit date
+    # rendered slomo video if it exists
+    if renderedslomopath:
+        exports.append((renderedslomopath, filename_prefix + "rendered_"))
+        tallies.append(("written", "Rendered slomos"))
 
-def tally_other_known_media():
-    log("Querying database for other known but irrelevant kinds of images...")
+    tallies.append(("total", "Considered"))
+    return exports, tallies, warnings, videopath
 
-    log("Tallying screenshots...", "info")
-    q = "SELECT 1 FROM RKMaster m" + pred(IS_SCREENSHOT, only_relevant_import_groups())
-    screenshots = query(q)
-    for l in screenshots:
-        tally("ignored", "Screenshots")
-        tally("total", "Considered")
+def plan_burst(medium):
+    burstpath = MASTERS + "/" + medium.path
 
-    log("Tallying screen recordings...", "info")
-    q = "SELECT 1 FROM RKMaster m" + pred(IS_SCREENRECORDING, only_relevant_import_groups())
-    screenrecordings = query(q)
-    for l in screenrecordings:
-        tally("ignored", "Screen recordings")
-        tally("total", "Considered")
-
-    log("Tallying WhatsApp images...", "info")
-    q = "SELECT 1 FROM RKMaster m" + pred(IS_WHATSAPP_PHOTO, only_relevant_import_groups())
-    whatsapp_images = query(q)
-    for l in whatsapp_images:
-        tally("ignored", "WhatsApp images")
-        tally("total", "Considered")
+    # TODO RKVersion contains column burstPickType indicating (weirdly?) which image was chosen as the "hero" image
 
-    log("Tallying WhatsApp videos...", "info")
-    q = "SELECT 1 FROM RKMaster m" + pred(IS_WHATSAPP_VIDEO, only_relevant_import_groups())
-    whatsapp_videos = query(q)
-    for l in whatsapp_videos:
-        tally("ignored", "WhatsApp videos")
-        tally("total", "Considered")
+    filename_prefix = assemble_filename_prefix(medium.creationdate, medium.id) + "burst_" + medium.burstid + "_"
+    return [(burstpath, filename_prefix)], [("written", "Burst mode photos"), ("total", "Considered")], [], burstpath
+
+def plan_panorama(medium):
+    panoramapath = MASTERS + "/" + medium.path
+    filename_prefix = assemble_filename_prefix(medium.creationdate, medium.id) + "panorama_"
+    return [(panoramapath, filename_prefix)], [("written", "Panoramas"), ("written", "Panoramas as JPEG"), ("total", "Considered")], [], panoramapath
+
+def plan_square(medium):
+    squarepath = MASTERS + "/" + medium.path
+    filename_prefix = assemble_filename_prefix(medium.creationdate, medium.id) + "square_"
+    return [(squarepath, filename_prefix)], [("written", "Square photos"), ("written", "Square photos as JPEG"), ("total", "Considered")], [], squarepath
+
+def plan_insta(medium):
+    instapath = MASTERS + "/" + medium.path
+
+    # TODO figure out how to get actual date? is that even possible? => from original file creation/edit date
+
+    filename_prefix = assemble_filename_prefix(medium.creationdate, medium.id) + "instagram_"
+    return [(instapath, filename_prefix)], [("written", "Instagrammed photos"), ("total", "Considered")], [], instapath
+
+def plan_ignored(label):
+    def plan(medium):
+        return [], [("ignored", label), ("total", "Considered")], [], ""
+    return plan
+
+def plan_unknown(medium):
+    UNKNOWN_MEDIA.append(MASTERS + "/" + medium.path)
+    return [], [], [], medium.path
+
+PLANS = {
+    "photo": plan_photo,
+    "video": plan_video,
+    "burst": plan_burst,
+    "panorama": plan_panorama,
+    "square": plan_square,
+    "insta": plan_insta,
+    "screenshot": plan_ignored("Screenshots"),
+    "screenrecording": plan_ignored("Screen recordings"),
+    "whatsapp_photo": plan_ignored("WhatsApp images"),
+    "whatsapp_video": plan_ignored("WhatsApp videos"),
+    "unknown": plan_unknown
+}
+
+# Capacity of the queues between pipeline stages (see export_media), bounding
+# how far a stage can run ahead of the next one.
+PIPELINE_QUEUE_SIZE = 64
+
+# marks the end of the items passing through a pipeline stage
+PIPELINE_END = None
+
+def pipeline_stage(fn, inq, outq, errors):
+    """
+    Starts a thread applying fn to each item from inq (or, if inq is an
+    iterable, to each of its items) and putting the result into outq.
+    """
+    def run():
+        try:
+            if isinstance(inq, queue.Queue):
+                items = iter(inq.get, PIPELINE_END)
+            else:
+                items = inq
+            for item in items:
+                outq.put(fn(item))
+        except BaseException as err:
+            errors.append(err)
+        finally:
+            outq.put(PIPELINE_END)
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    return t
+
+@phase("export_media")
+def export_media():
+    """
+    Exports all relevant media in a pipeline of threads with bounded queues
+    between them:
+
+        enumerate and match (query the database, classify media, match them
+            with live photo videos and rendered versions)
+        -> copy (to the staging directory, queueing JPEG conversions for the
+            pool of conversion workers, see convert_later)
+        -> record (log staged files, tally, report progress), on the main thread.
+
+    The indexes needed for matching are built in the background at the same
+    time as the database is queried.
+    """
+    log("Querying database and classifying media...")
+    total = count_media()
+
+    # the indexes are built one after the other since they share the exiftool
+    # pool and the directory snapshot
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as indexers:
+        INDEXES["live"] = indexers.submit(build_live_photo_index)
+        INDEXES["version"] = indexers.submit(build_version_index)
+
+        def match(item):
+            category, medium = item
+            return PLANS[category](medium)
+
+        def copy(plan):
+            exports, tallies, warnings, path = plan
+            entries = []
+            for sourcepath, prefix in exports:
+                entries.extend(export_file(sourcepath, prefix))
+            return entries, tallies, warnings, path
+
+        matched = queue.Queue(PIPELINE_QUEUE_SIZE)
+        copied = queue.Queue(PIPELINE_QUEUE_SIZE)
+        pipeline_stage(match, enumerate_media(), matched, errors)
+        pipeline_stage(copy, matched, copied, errors)
+
+        log("Collecting photos, live photo videos, edited photos, videos, rendered slomos, burst photos, panoramas, square photos and Instagram photos, creating JPEG versions...")
+        progress(0, total)
+        for i, (entries, tallies, warnings, path) in enumerate(iter(copied.get, PIPELINE_END)):
+            for w in warnings:
+                log(w, "warn")
+            for entry in entries:
+                log_file(*entry)
+            for mode, category in tallies:
+                tally(mode, category)
+            progress(i+1, total, os.path.basename(path))
+
+    if errors:
+        raise errors[0]
 
 def list_unknown_media():
     log("The following media could not be categorized (you'll have to copy these manually if you need them):")
 
-    q = "SELECT m.imagePath FROM RKMaster m" + pred(
-        pnot(IS_PHOTO),
-        pnot(IS_VIDEO),
-        pnot(IS_BURST),
-        pnot(IS_PANORAMA),
-        pnot(IS_SQUARE),
-        pnot(IS_INSTA),
-        pnot(IS_SCREENSHOT),
-        pnot(IS_SCREENRECORDING),
-        pnot(IS_WHATSAPP_PHOTO),
-        pnot(IS_WHATSAPP_VIDEO),
-        only_relevant_import_groups())
-    unknowns = query(q)
+    unknowns = UNKNOWN_MEDIA
     for l in unknowns:
-        print(MASTERS + "/" + l[0])
+        print(l)
         tally("ignored", "Unknown/uncategorized media")
         tally("total", "Considered")
 
 def main():
+    if args.benchmark_converters is not None:
+        benchmark_converters(args.benchmark_converters)
+        return
+
+    global PROFILER
+    RUN["started"] = (datetime.now(), measure())
+    if args.profile:
+        tracemalloc.start()
+        PROFILER = cProfile.Profile()
+        PROFILER.enable()
+
     atexit.register(clean_up)
 
+    if args.watch is not None:
+        watch(args.watch)
+    elif not export(lambda: input("All good (y/N)?") == "y"):
+        sys.exit(-1)  # cleanup will happen automatically, keeping staged files
+
+def export(confirm):
+    """
+    Exports everything not exported yet, persisting it to the TARGET if confirm
+    returns true – returns whether that's the case.
+    """
     create_working_copy_of_photos_db()
     read_cache()
+    prepare_database()
 
-    collect_photos()
-    collect_videos()
-    collect_bursts()
-    collect_panoramas()
-    collect_squares()
-    collect_insta_photos()
+    check_converter()
+    choose_staging_strategy()
+    open_journal()
+    scan_target()
+    start_conversion_workers()
+    export_media()
+    finish_conversions()
 
-    tally_other_known_media()
     list_unknown_media()
     stats()
 
-    response = input("All good (y/N)?")
-    if response != "y":
-        sys.exit(-1)  # cleanup will happen automatically
+    if not confirm():
+        return False
 
     persist_files_to_target()
     write_cache()
+    RUN["completed"] = True
+    return True
+
+def poll_database(watcher, signature):
+    """
+    Returns whether anything has been committed to photos.db since the given
+    signature was taken, along with the current signature. The modification
+    times of the database and its write-ahead log are cheap to check, but also
+    change when SQLite merely checkpoints, so only then SQLite is asked whether
+    there's been a commit, via the data_version of the read-only connection
+    watcher.
+    """
+    mtimes = []
+    for path in [DATABASE, DATABASE + "-wal"]:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    if signature is not None and mtimes == signature[0]:
+        return False, signature
+    data_version = watcher.execute("PRAGMA data_version").fetchone()[0]
+    return signature is None or data_version != signature[1], (mtimes, data_version)
+
+def new_import_groups(watcher):
+    """
+    Returns the number of masters of each import group not exported yet.
+    """
+    with STATE_LOCK:
+        exported = set(r[0] for r in STATE.execute("SELECT uuid FROM import_groups"))
+    q = "SELECT COALESCE(importGroupUuid, ?), COUNT(*) FROM RKMaster GROUP BY importGroupUuid"
+    return {g: n for g, n in watcher.execute(q, (NO_IMPORT_GROUP,)) if g not in exported}
+
+def reset_run():
+    """
+    Forgets about the previous run, except for what watch keeps around.
+    """
+    global PROFILER
+    for l in [TMP_FILES, IDENTICAL, UNKNOWN_MEDIA, DUPLICATES, CONFLICTS, CONVERSION_ERRORS]:
+        l.clear()
+    ENUMERATED_IMPORT_GROUPS.clear()
+    for d in [TARGET_FILES, SOURCES, STAGED, PERSISTED, INDEXES, COUNTERS, PHASES, *TALLY.values()]:
+        d.clear()
+    RUN["started"] = (datetime.now(), measure())
+    RUN["completed"] = False
+    PROFILER = None
+
+def watch(interval):
+    """
+    Keeps polling photos.db and exports new import groups (including those
+    already there when starting) once their number of masters has stayed the
+    same for an interval, i.e. Photos is done importing them, with the exiftool
+    pool, the export state and the directory snapshot kept around in between.
+    Instead of asking for confirmation, exports are persisted unless there
+    were warnings that may clear up (see retryable_warning), in which case
+    they're retried up to WATCH_RETRIES times first.
+    """
+    global DATABASE_MODE
+    global SETTLED_IMPORT_GROUPS
+    DATABASE_MODE = WATCH_DATABASE_MODE
+    SETTLED_IMPORT_GROUPS = set()
+    connect_state()  # for new_import_groups, kept open by open_state
+    watcher = sqlite3.connect(database_uri(DATABASE, mode="ro"), uri=True)
+    signature = None
+    sizes = {}  # masters per new import group as of the previous poll
+    pending = False
+    attempts = 0
+
+    def confirm():
+        return COUNTERS.get("retryable_warnings", 0) == 0 or attempts > WATCH_RETRIES
+
+    log("Watching " + DATABASE + " for new imports (press Ctrl-C to stop)...")
+    while True:
+
+        # import groups that haven't settled yet need another look even if
+        # nothing has been committed since
+        changed, signature = poll_database(watcher, signature)
+        if changed or sizes:
+            current = new_import_groups(watcher)
+            settled = set(g for g, n in current.items() if sizes.get(g) == n)
+            sizes = current
+            if settled and not pending:
+                log("Found new imports in " + DATABASE + ".")
+                pending = True
+            if settled:
+                SETTLED_IMPORT_GROUPS = settled
+
+        if pending:
+            attempts += 1
+            reset_run()
+            try:
+                completed = export(confirm)
+            finally:
+                end_run()
+            if completed:
+                attempts = 0
+                log("Watching " + DATABASE + " for new imports (press Ctrl-C to stop)...")
+            else:
+                log("There were warnings that may clear up, will try again in " + str(interval) + " seconds (" + str(attempts) + " of " + str(WATCH_RETRIES) + " retries).", "info")
+            pending = not completed
+
+        try:
+            time.sleep(interval)
+        except KeyboardInterrupt:
+            return
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,183 @@
+"""
+Runs apple-photos-export.py against a synthetic library (see
+synthetic_library.py), using the stand-in sips and exiftool commands in
+benchmarks/stand-ins so it works without macOS, and times each phase of main().
+
+Each benchmark consists of a cold run into an empty target, followed by a warm
+run into the same target (where everything has already been exported). The
+results are written to a JSON file in the results directory, named after the
+time of the benchmark, so they can be compared over time.
+
+    python3 benchmarks/end_to_end.py [-n MASTERS] [--library LIBRARY] [--results DIR]
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import platform
+import tempfile
+import argparse
+import contextlib
+import subprocess
+import importlib.util
+from datetime import datetime, timezone
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCHMARKS)
+SCRIPT = os.path.join(REPO, "apple-photos-export.py")
+STAND_INS = os.path.join(BENCHMARKS, "stand-ins")
+
+sys.path.insert(0, REPO)
+sys.path.insert(0, BENCHMARKS)
+import synthetic_library
+
+# Functions called by main(), in order, each of which is timed as a phase.
+PHASES = [
+    "create_working_copy_of_photos_db",
+    "read_cache",
+    "prepare_database",
+    "check_converter",
+    "choose_staging_strategy",
+    "scan_target",
+    "start_conversion_workers",
+    "export_media",
+    "finish_conversions",
+    "list_unknown_media",
+    "stats",
+    "persist_files_to_target",
+    "write_cache",
+    "clean_up"
+]
+
+CONFIG = """[Paths]
+ApplePhotosLibrary = {library}
+TemporaryStorage = {tmp}
+
+[Conversion]
+Backend = sips
+Sips = {sips}
+
+[Staging]
+Strategy = {staging}
+"""
+
+def timed(fn, name, phases):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            phases[name] = phases.get(name, 0) + time.perf_counter() - start
+    return wrapper
+
+def run(name, target, verbose=False):
+    """
+    Runs the script once (answering its confirmation prompt with "y") and
+    returns the timings of its phases along with some counts.
+    """
+    phases = {}
+    argv = sys.argv
+    sys.argv = [SCRIPT, target]
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    start = time.perf_counter()
+    try:
+        with output:
+
+            # parsing arguments and configuration happens at import time
+            setup_start = time.perf_counter()
+            spec = importlib.util.spec_from_file_location("apple_photos_export", SCRIPT)
+            script = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(script)
+            phases["setup"] = time.perf_counter() - setup_start
+
+            for phase in PHASES:
+                setattr(script, phase, timed(getattr(script, phase), phase, phases))
+            script.input = lambda prompt: "y"
+
+            script.main()
+            script.clean_up()
+            atexit.unregister(script.clean_up)
+    finally:
+        sys.argv = argv
+    total = time.perf_counter() - start
+
+    return {
+        "name": name,
+        "total": total,
+        "phases": phases,
+        "files": len(script.TMP_FILES),
+        "tallies": script.TALLY,
+        "counters": script.COUNTERS
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def report(result):
+    print(result["name"] + " run: " + str(round(result["total"], 2)) + " seconds, " + str(result["files"]) + " files")
+    width = max(len(p) for p in result["phases"])
+    for phase, seconds in result["phases"].items():
+        print("  " + phase.ljust(width) + " | " + str(round(seconds, 3)).rjust(8))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=1000, dest="masters", help="number of masters in the synthetic library (default 1000)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic library (default 0)")
+    parser.add_argument("--library", help="use this previously generated library instead of generating one")
+    parser.add_argument("--staging", default="auto", help="staging strategy (default auto)")
+    parser.add_argument("--results", default=os.path.join(BENCHMARKS, "results"), help="directory the JSON results are written to (default benchmarks/results)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the script's output")
+    args = parser.parse_args()
+
+    os.environ["PATH"] = STAND_INS + os.pathsep + os.environ["PATH"]
+
+    with tempfile.TemporaryDirectory(prefix="apple-photos-export-benchmark-") as workdir:
+        library = args.library
+        counts = None
+        if not library:
+            library = os.path.join(workdir, "Synthetic.photoslibrary")
+            print("Generating synthetic library with " + str(args.masters) + " masters...")
+            start = time.perf_counter()
+            counts = synthetic_library.generate(library, args.masters, args.seed)
+            print("  took " + str(round(time.perf_counter() - start, 2)) + " seconds")
+
+        target = os.path.join(workdir, "target")
+        os.makedirs(target)
+        with open(os.path.join(target, "apple-photos-export.ini"), "w") as f:
+            f.write(CONFIG.format(library=library,
+                                  tmp=os.path.join(workdir, "tmp"),
+                                  sips=os.path.join(STAND_INS, "sips"),
+                                  staging=args.staging))
+
+        runs = []
+        for name in ["cold", "warm"]:
+            runs.append(run(name, target, args.verbose))
+            report(runs[-1])
+
+    results = {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "masters": args.masters if not args.library else None,
+        "seed": args.seed if not args.library else None,
+        "library": args.library,
+        "kinds": counts,
+        "staging": args.staging,
+        "runs": runs
+    }
+    os.makedirs(args.results, exist_ok=True)
+    filename = "end_to_end-" + datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S") + ".json"
+    path = os.path.join(args.results, filename)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to " + path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Compares full metadata extraction with the tag-projected, -fast2 extraction
+used for building the Live Photo video and rendered version indexes, on a set of
+synthetic QuickTime files. Requires exiftool.
+
+    python3 benchmarks/exiftool_projection.py [-n FILES] [--mdat-size BYTES]
+"""
+
+import os
+import sys
+import time
+import struct
+import uuid
+import tempfile
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyexiftool.exiftool as exif
+
+TAGS = ["QuickTime:ContentIdentifier", "QuickTime:DateTimeOriginal"]
+
+def atom(kind, payload):
+    return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+def metadata_item(index, value):
+    data = atom(b"data", struct.pack(">II", 1, 0) + value.encode("utf-8"))
+    return atom(struct.pack(">I", index), data)
+
+def quicktime_file(contentidentifier, mdat_size):
+    """
+    Assembles a minimal QuickTime movie resembling a Live Photo video: media
+    data followed by a movie header, a dummy track and a few Apple metadata
+    keys, among them the content identifier.
+    """
+    keys = [
+        ("com.apple.quicktime.content.identifier", contentidentifier),
+        ("com.apple.quicktime.creationdate", "2018-09-22T09:02:04+0200"),
+        ("com.apple.quicktime.make", "Apple"),
+        ("com.apple.quicktime.model", "iPhone 7"),
+        ("com.apple.quicktime.software", "12.1.2"),
+        ("com.apple.quicktime.location.ISO6709", "+48.5200+009.0570+341.000/")
+    ]
+    keys_payload = struct.pack(">II", 0, len(keys)) + b"".join(
+        struct.pack(">I", 8 + len(k)) + b"mdta" + k.encode("utf-8") for k, _ in keys)
+    ilst_payload = b"".join(metadata_item(i + 1, v) for i, (_, v) in enumerate(keys))
+    meta = atom(b"meta",
+                atom(b"hdlr", struct.pack(">II", 0, 0) + b"mdta" + b"\0" * 13)
+                + atom(b"keys", keys_payload)
+                + atom(b"ilst", ilst_payload))
+
+    mvhd = atom(b"mvhd", struct.pack(">IIIIII", 0, 0, 0, 600, 1800, 0x10000)
+                + struct.pack(">H", 0x100) + b"\0" * 10
+                + struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+                + b"\0" * 24 + struct.pack(">I", 2))
+    tkhd = atom(b"tkhd", struct.pack(">IIIIII", 0xf, 0, 0, 1, 0, 1800) + b"\0" * 16
+                + struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+                + struct.pack(">II", 1440 << 16, 1080 << 16))
+    trak = atom(b"trak", tkhd)
+    moov = atom(b"moov", mvhd + trak + meta)
+
+    ftyp = atom(b"ftyp", b"qt  " + struct.pack(">I", 0) + b"qt  ")
+    mdat = atom(b"mdat", os.urandom(mdat_size))
+    return ftyp + mdat + moov
+
+def run(label, fn, files):
+    start = time.perf_counter()
+    results = list(fn(files))
+    elapsed = time.perf_counter() - start
+    print(label.ljust(24) + " | " + str(round(len(files) / elapsed, 1)).rjust(8) + " files/second")
+    return results, elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=500, dest="files", help="number of synthetic QuickTime files (default 500)")
+    parser.add_argument("--mdat-size", type=int, default=256 * 1024, dest="mdat_size", help="size of the media data of each file in bytes (default 256 KiB)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="number of exiftool processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = []
+        for i in range(args.files):
+            path = os.path.join(tmpdir, "jpegvideocomplement_%x.mov" % i)
+            with open(path, "wb") as f:
+                f.write(quicktime_file(str(uuid.uuid4()).upper(), args.mdat_size))
+            files.append(path)
+
+        with exif.ExifToolPool(args.processes) as pool:
+            full, full_time = run("full extraction", pool.iter_metadata, files)
+            projected, projected_time = run("projected, -fast2", lambda f: pool.iter_tags(TAGS, f, fast=2), files)
+
+    found = sum(1 for d in projected if "QuickTime:ContentIdentifier" in d)
+    print("speedup".ljust(24) + " | " + str(round(full_time / projected_time, 2)).rjust(8) + "x")
+    print("content identifiers".ljust(24) + " | " + str(found).rjust(8) + "/" + str(len(files)))
+    print("tags per file".ljust(24) + " | " + str(round(sum(len(d) for d in full) / len(full), 1)).rjust(8)
+          + " vs. " + str(round(sum(len(d) for d in projected) / len(projected), 1)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Generates a synthetic Apple Photos library: a database/photos.db with RKMaster,
+RKVersion and RKAttachment rows for every kind of media apple-photos-export.py
+knows about, plus tiny stand-in files in Masters/, resources/media/master (Live
+Photo videos) and resources/media/version (rendered slomos, edited photos and
+their edited Live Photo videos).
+
+Stand-in videos and rendered versions contain their metadata as JSON, which is
+what the stand-in exiftool in benchmarks/stand-ins reports.
+
+    python3 benchmarks/synthetic_library.py LIBRARY [-n MASTERS] [--seed SEED]
+"""
+
+import os
+import json
+import uuid
+import random
+import sqlite3
+import argparse
+from datetime import datetime, timezone
+
+# Rough make-up of a camera roll imported from an iPhone, as (kind, share).
+KINDS = [
+    ("photo", 0.55),
+    ("video", 0.06),
+    ("slomo", 0.02),
+    ("burst", 0.05),
+    ("panorama", 0.01),
+    ("square", 0.02),
+    ("insta", 0.02),
+    ("screenshot", 0.12),
+    ("screenrecording", 0.01),
+    ("whatsapp_photo", 0.09),
+    ("whatsapp_video", 0.02),
+    ("unknown", 0.03)
+]
+
+EXTENSIONS = {
+    "photo": "HEIC", "video": "MOV", "slomo": "MOV", "burst": "JPG",
+    "panorama": "HEIC", "square": "HEIC", "insta": "JPG", "screenshot": "PNG",
+    "screenrecording": "MP4", "whatsapp_photo": "jpg", "whatsapp_video": "mp4",
+    "unknown": "GIF"
+}
+
+UTIS = {
+    "HEIC": "public.heic", "MOV": "com.apple.quicktime-movie",
+    "JPG": "public.jpeg", "jpg": "public.jpeg", "PNG": "public.png",
+    "MP4": "public.mpeg-4", "mp4": "public.mpeg-4", "GIF": "com.compuserve.gif"
+}
+
+# Just the columns apple-photos-export.py looks at.
+SCHEMA = """
+CREATE TABLE RKMaster (modelId INTEGER PRIMARY KEY, uuid VARCHAR, imagePath VARCHAR, filename VARCHAR, fileCreationDate TIMESTAMP, fileModificationDate TIMESTAMP, mediaGroupId VARCHAR, groupingUuid VARCHAR, burstUuid VARCHAR, UTI VARCHAR, importGroupUuid VARCHAR, width INTEGER, height INTEGER, hasAttachments INTEGER);
+CREATE TABLE RKVersion (modelId INTEGER PRIMARY KEY, uuid VARCHAR, masterUuid VARCHAR, selfPortrait INTEGER, adjustmentUuid VARCHAR, burstPickType INTEGER);
+CREATE TABLE RKAttachment (modelId INTEGER PRIMARY KEY, uuid VARCHAR, attachedToUuid VARCHAR, filePath VARCHAR, fileModificationDate TIMESTAMP);
+"""
+
+# Photos' timestamps are offset from the Unix epoch by this much (see
+# weird_apple_timestamp_to_unix in apple-photos-export.py).
+APPLE_EPOCH = 977616000 + 691200
+
+# Number of masters per import group.
+IMPORT_SIZE = 200
+
+# Rows are inserted in batches of this size.
+BATCH_SIZE = 10000
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+def generate(library, masters, seed=0):
+    """
+    Generates a library with the given number of masters, deterministically for
+    a given seed. Returns the number of masters of each kind.
+    """
+    rnd = random.Random(seed)
+    newuuid = lambda: str(uuid.UUID(int=rnd.getrandbits(128), version=4)).upper()
+    kinds, weights = zip(*KINDS)
+
+    if os.path.exists(library):
+        raise FileExistsError(library + " already exists")
+    os.makedirs(os.path.join(library, "database"))
+    db = sqlite3.connect(os.path.join(library, "database", "photos.db"))
+    db.executescript(SCHEMA)
+
+    counts = {k: 0 for k in kinds}
+    rows = {"RKMaster": [], "RKVersion": [], "RKAttachment": []}
+
+    def flush():
+        for table, batch in rows.items():
+            if batch:
+                placeholders = ",".join("?" * len(batch[0]))
+                db.executemany("INSERT INTO " + table + " VALUES (" + placeholders + ")", batch)
+                batch.clear()
+
+    ts = 560000000  # late september 2018 in Photos' terms
+    burst = None
+    for id in range(1, masters + 1):
+
+        # each import gets its own directory named after the time of import
+        if (id - 1) % IMPORT_SIZE == 0:
+            importgroup = newuuid()
+            importdate = datetime.fromtimestamp(ts + APPLE_EPOCH, timezone.utc)
+            importdir = importdate.strftime("%Y/%m/%d/%Y%m%d-%H%M%S")
+
+        kind = rnd.choices(kinds, weights)[0]
+        counts[kind] += 1
+        ts += rnd.randint(1, 600)
+
+        u = newuuid()
+        ext = EXTENSIONS[kind]
+        filename = "IMG_%04d.%s" % (id % 10000, ext)
+        mediagroup = grouping = burstuuid = None
+        width, height = 4032, 3024
+        attachments = 0
+
+        if kind == "photo":
+            mediagroup = newuuid()
+            grouping = mediagroup
+        elif kind == "burst":
+            if burst is None or rnd.random() < 0.1:
+                burst = newuuid().replace("-", "")[:22]
+            burstuuid = burst
+        elif kind == "square":
+            width = height = 3024
+        elif kind == "insta":
+            mediagroup = newuuid()
+        elif kind == "screenrecording":
+            filename = "RPReplay_Final%d.%s" % (ts + APPLE_EPOCH, ext)
+        elif kind in ("whatsapp_photo", "whatsapp_video"):
+            filename = newuuid() + "." + ext
+        elif kind == "slomo":
+            attachments = 1
+
+        imagepath = importdir + "/" + filename
+        rows["RKMaster"].append((id, u, imagepath, filename, ts, ts, mediagroup, grouping, burstuuid, UTIS[ext], importgroup, width, height, attachments))
+        edited = kind == "photo" and rnd.random() < 0.05
+        adjustment = newuuid() if edited else "UNADJUSTEDNONRAW"
+        rows["RKVersion"].append((id, newuuid(), u, int(kind == "photo" and rnd.random() < 0.1), adjustment, None))
+        write(os.path.join(library, "Masters", imagepath), ext * rnd.randint(1, 64))
+
+        # live photo video with matching content identifier (missing for a few
+        # photos, as happens with Live Photos turned off)
+        if kind == "photo" and rnd.random() < 0.98:
+            path = os.path.join(library, "resources/media/master", "%02X" % (id % 256), "00", "jpegvideocomplement_%x.mov" % id)
+            write(path, json.dumps({"QuickTime:ContentIdentifier": mediagroup}))
+
+            # edited live photos get an edited video, too
+            if edited:
+                path = os.path.join(library, "resources/media/version", "%02X" % (id % 256), "00", "videocomplementoutput_%x.mov" % id)
+                write(path, json.dumps({"QuickTime:ContentIdentifier": mediagroup}))
+
+        # rendered version of an edited photo with the same content identifier
+        if edited:
+            path = os.path.join(library, "resources/media/version", "%02X" % (id % 256), "00", "fullsizeoutput_%x.jpeg" % id)
+            write(path, json.dumps({"Apple:ContentIdentifier": mediagroup}))
+
+        # rendered slomo whose creation date matches the attachment's
+        # modification date
+        if kind == "slomo":
+            modified = ts + rnd.randint(1, 120)
+            rows["RKAttachment"].append((None, newuuid(), u, "Attachments/" + importdir + "/" + u + ".plist", modified))
+            created = datetime.fromtimestamp(modified + APPLE_EPOCH, timezone.utc).strftime("%Y:%m:%d %H:%M:%S+00:00")
+            path = os.path.join(library, "resources/media/version", "%02X" % (id % 256), "00", "fullsizeoutput_%x.mov" % id)
+            write(path, json.dumps({"QuickTime:DateTimeOriginal": created}))
+
+        if len(rows["RKMaster"]) >= BATCH_SIZE:
+            flush()
+
+    flush()
+    db.commit()
+    db.close()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("library", metavar="LIBRARY", help="path of the library to generate (e.g. /tmp/Synthetic.photoslibrary)")
+    parser.add_argument("-n", type=int, default=1000, dest="masters", help="number of masters (default 1000)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default 0)")
+    args = parser.parse_args()
+
+    counts = generate(args.library, args.masters, args.seed)
+    for kind, count in counts.items():
+        print(kind.ljust(16) + " | " + str(count))
+
+if __name__ == "__main__":
+    main()
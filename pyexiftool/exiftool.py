@@ -61,12 +61,20 @@ import os
 import json
 import warnings
 import codecs
+import select
+import threading
+import time
 
 try:        # Py3k compatibility
     basestring
 except NameError:
     basestring = (bytes, str)
 
+try:        # Py3k compatibility
+    import queue
+except ImportError:
+    import Queue as queue
+
 executable = "exiftool"
 """The name of the executable to run.
 
@@ -83,6 +91,10 @@ sentinel = b"{ready}"
 # some cases.
 block_size = 4096
 
+# The number of files per ``-execute`` when streaming metadata with
+# the ``iter_*`` methods.
+chunk_size = 64
+
 # This code has been adapted from Lib/os.py in the Python source tree
 # (sha1 265e36e277f3)
 def _fscodec():
@@ -112,6 +124,35 @@ def _fscodec():
 fsencode = _fscodec()
 del _fscodec
 
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _tag_params(tags, fast):
+    # Explicitly ruling out strings here because passing in a string
+    # would lead to strange and hard-to-find errors
+    if isinstance(tags, basestring):
+        raise TypeError("The argument 'tags' must be "
+                        "an iterable of strings")
+    params = ["-" + t for t in tags]
+    if fast:
+        params.insert(0, "-fast" if fast == 1 else "-fast%d" % fast)
+    return params
+
+class ExifToolError(Exception):
+    """Raised if the ``exiftool`` process died or didn't respond in time.
+
+    The affected :py:class:`ExifTool` instance is no longer running
+    afterwards.
+    """
+    pass
+
 class ExifTool(object):
     """Run the `exiftool` command-line tool and communicate to it.
 
@@ -146,13 +187,20 @@ class ExifTool(object):
 
        A Boolean value indicating whether this instance is currently
        associated with a running subprocess.
+
+    .. py:attribute:: timeout
+
+       The number of seconds :py:meth:`execute()` waits for output
+       from ``exiftool`` before giving up, or ``None`` (the default)
+       to wait indefinitely.  Can be passed to the constructor.
     """
 
-    def __init__(self, executable_=None):
+    def __init__(self, executable_=None, timeout=None):
         if executable_ is None:
             self.executable = executable
         else:
             self.executable = executable_
+        self.timeout = timeout
         self.running = False
 
     def start(self):
@@ -181,9 +229,35 @@ class ExifTool(object):
         """
         if not self.running:
             return
-        self._process.stdin.write(b"-stay_open\nFalse\n")
-        self._process.stdin.flush()
-        self._process.communicate()
+        try:
+            self._process.stdin.write(b"-stay_open\nFalse\n")
+            self._process.stdin.flush()
+            self._process.communicate()
+        except (IOError, OSError, ValueError):
+            # the process has died already
+            self.kill()
+            return
+        del self._process
+        self.running = False
+
+    def kill(self):
+        """Forcibly kill the ``exiftool`` process of this instance.
+
+        Useful if the process hangs.  If the subprocess isn't running,
+        this method will do nothing.
+        """
+        if not self.running:
+            return
+        try:
+            self._process.kill()
+        except OSError:
+            pass
+        self._process.wait()
+        for f in (self._process.stdin, self._process.stdout):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
         del self._process
         self.running = False
 
@@ -218,13 +292,29 @@ class ExifTool(object):
         """
         if not self.running:
             raise ValueError("ExifTool instance not running.")
-        self._process.stdin.write(b"\n".join(params + (b"-execute\n",)))
-        self._process.stdin.flush()
-        output = b""
+        try:
+            self._process.stdin.write(b"\n".join(params + (b"-execute\n",)))
+            self._process.stdin.flush()
+        except (IOError, OSError):
+            self.kill()
+            raise ExifToolError("exiftool process died")
+        output = bytearray()
         fd = self._process.stdout.fileno()
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
         while not output[-32:].strip().endswith(sentinel):
-            output += os.read(fd, block_size)
-        return output.strip()[:-len(sentinel)]
+            if self.timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                    self.kill()
+                    raise ExifToolError("exiftool process didn't respond "
+                                        "within %s seconds" % self.timeout)
+            block = os.read(fd, block_size)
+            if not block:
+                self.kill()
+                raise ExifToolError("exiftool process died")
+            output += block
+        return bytes(output.strip()[:-len(sentinel)])
 
     def execute_json(self, *params):
         """Execute the given batch of parameters and parse the JSON output.
@@ -259,6 +349,20 @@ class ExifTool(object):
         """
         return self.execute_json(*filenames)
 
+    def iter_metadata(self, filenames, chunk_size_=None):
+        """Return an iterator over the meta-data of the given files.
+
+        Unlike :py:meth:`get_metadata_batch()`, this method passes the
+        files to ``exiftool`` in chunks of ``chunk_size_`` (default:
+        the module-level ``chunk_size``) files and yields the
+        dictionaries of each chunk as soon as it has been processed,
+        so memory usage doesn't grow with the number of files.
+        ``filenames`` may be any iterable, including a generator.
+        """
+        for chunk in _chunks(filenames, chunk_size_ or chunk_size):
+            for d in self.execute_json(*chunk):
+                yield d
+
     def get_metadata(self, filename):
         """Return meta-data for a single file.
 
@@ -290,6 +394,27 @@ class ExifTool(object):
         params.extend(filenames)
         return self.execute_json(*params)
 
+    def iter_tags(self, tags, filenames, chunk_size_=None, fast=0):
+        """Return an iterator over the specified tags of the given files.
+
+        Like :py:meth:`get_tags_batch()`, but streaming in chunks as
+        described for :py:meth:`iter_metadata()`.
+
+        Since only the specified tags are extracted, this is a lot
+        cheaper than :py:meth:`iter_metadata()` if just a few tags are
+        needed.  If ``fast`` is 1 or 2, ``exiftool`` is additionally
+        run with ``-fast`` or ``-fast2`` respectively, i.e. it doesn't
+        scan to the end of the file for trailers (and, with 2, skips
+        maker notes).
+        """
+        if isinstance(filenames, basestring):
+            raise TypeError("The argument 'filenames' must be "
+                            "an iterable of strings")
+        params = _tag_params(tags, fast)
+        for chunk in _chunks(filenames, chunk_size_ or chunk_size):
+            for d in self.execute_json(*(params + chunk)):
+                yield d
+
     def get_tags(self, tags, filename):
         """Return only specified tags for a single file.
 
@@ -323,3 +448,221 @@ class ExifTool(object):
         ``None`` if this tag was not found in the file.
         """
         return self.get_tag_batch(tag, [filename])[0]
+
+
+class ExifToolPool(object):
+    """Run several `exiftool` processes and spread batches across them.
+
+    Batches of files passed to the ``*_batch`` methods are split into
+    chunks of ``chunk_size`` files, which are distributed among
+    ``size`` :py:class:`ExifTool` instances (by default, one per CPU)
+    running in batch mode.  The results are merged such that they are
+    in the same order as the input, just like the results of the
+    corresponding :py:class:`ExifTool` methods.
+
+    If an ``exiftool`` process dies or doesn't respond within
+    ``timeout`` seconds, it is replaced by a fresh one and the chunk
+    it was working on is retried (up to ``retries`` times, after which
+    :py:class:`ExifToolError` is raised).
+
+    Like :py:class:`ExifTool`, a pool can be used as a context
+    manager::
+
+        with ExifToolPool(4) as pool:
+            metadata = pool.get_metadata_batch(files)
+
+    A pool is meant to be used from a single thread at a time.
+    """
+
+    def __init__(self, size=None, executable_=None, chunk_size=64,
+                 timeout=None, retries=2):
+        if size is None:
+            try:
+                import multiprocessing
+                size = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                size = 1
+        self.size = max(1, size)
+        self.executable = executable_
+        self.chunk_size = max(1, chunk_size)
+        self.timeout = timeout
+        self.retries = retries
+        self.restarts = 0
+        self._workers = []
+
+    @property
+    def running(self):
+        """Whether the processes of this pool have been started."""
+        return bool(self._workers)
+
+    def start(self):
+        """Start the ``exiftool`` processes of this pool."""
+        if self._workers:
+            warnings.warn("ExifToolPool already running; doing nothing.")
+            return
+        for i in range(self.size):
+            et = ExifTool(self.executable, self.timeout)
+            et.start()
+            self._workers.append(et)
+
+    def terminate(self):
+        """Terminate all ``exiftool`` processes of this pool."""
+        for et in self._workers:
+            et.terminate()
+        self._workers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.terminate()
+
+    def __del__(self):
+        self.terminate()
+
+    def _execute_chunk(self, et, params, chunk):
+        for attempt in range(self.retries + 1):
+            if not et.running:
+                et.start()
+                self.restarts += 1
+            try:
+                return et.execute_json(*(params + chunk))
+            except ExifToolError as e:
+                error = e
+        raise error
+
+    def iter_json_batch(self, params, filenames, chunk_size_=None):
+        """Run ``exiftool`` with the given parameters on the given files.
+
+        The files are split into chunks of ``chunk_size_`` (default:
+        the pool's ``chunk_size``) files, which are processed
+        concurrently, each with the given parameters prepended.  The
+        resulting dictionaries (see :py:meth:`ExifTool.execute_json()`)
+        are yielded in input order as soon as the respective chunk is
+        done.  At most two chunks per process are in flight or waiting
+        to be consumed at any time, so memory usage doesn't grow with
+        the number of files, which may be any iterable.
+        """
+        if not self._workers:
+            raise ValueError("ExifToolPool instance not running.")
+        if isinstance(filenames, basestring):
+            raise TypeError("The argument 'filenames' must be "
+                            "an iterable of strings")
+        params = list(params)
+        workers = list(self._workers)
+        window = threading.Semaphore(2 * len(workers))
+        work = queue.Queue()
+        cond = threading.Condition()
+        results = {}
+        errors = []
+        state = {"feeding": True, "total": 0, "stopped": False}
+
+        def feed():
+            n = 0
+            try:
+                for chunk in _chunks(filenames, chunk_size_ or self.chunk_size):
+                    window.acquire()
+                    if state["stopped"]:
+                        break
+                    work.put((n, chunk))
+                    n += 1
+            except Exception as e:
+                with cond:
+                    errors.append(e)
+            for et in workers:
+                work.put(None)
+            with cond:
+                state["feeding"] = False
+                state["total"] = n
+                cond.notify_all()
+
+        def process(et):
+            while True:
+                item = work.get()
+                if item is None:
+                    return
+                i, chunk = item
+                if state["stopped"]:
+                    continue
+                # any error, not just ExifToolError (e.g. a ValueError if
+                # exiftool printed nothing because all files of the chunk
+                # are gone), is handed to the consumer, which would wait
+                # for the chunk forever otherwise
+                try:
+                    result = self._execute_chunk(et, params, chunk)
+                except Exception as e:
+                    with cond:
+                        errors.append(e)
+                        cond.notify_all()
+                    continue
+                with cond:
+                    results[i] = result
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=feed)]
+        threads.extend(threading.Thread(target=process, args=(et,))
+                       for et in workers)
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            i = 0
+            while True:
+                with cond:
+                    while (i not in results and not errors
+                           and (state["feeding"] or i < state["total"])):
+                        cond.wait()
+                    if errors:
+                        raise errors[0]
+                    if i not in results:
+                        break
+                    result = results.pop(i)
+                window.release()
+                for d in result:
+                    yield d
+                i += 1
+        finally:
+            state["stopped"] = True
+            for t in threads:
+                window.release()
+            for t in threads:
+                t.join()
+
+    def execute_json_batch(self, params, filenames):
+        """Run ``exiftool`` with the given parameters on the given files.
+
+        Like :py:meth:`iter_json_batch()`, but returns a list.
+        """
+        return list(self.iter_json_batch(params, filenames))
+
+    def iter_metadata(self, filenames, chunk_size_=None):
+        """Return an iterator over the meta-data of the given files.
+
+        Equivalent to :py:meth:`ExifTool.iter_metadata()`, with the
+        chunks being processed concurrently.
+        """
+        return self.iter_json_batch([], filenames, chunk_size_)
+
+    def iter_tags(self, tags, filenames, chunk_size_=None, fast=0):
+        """Return an iterator over the specified tags of the given files.
+
+        Equivalent to :py:meth:`ExifTool.iter_tags()`, with the chunks
+        being processed concurrently.
+        """
+        return self.iter_json_batch(_tag_params(tags, fast), filenames,
+                                    chunk_size_)
+
+    def get_metadata_batch(self, filenames):
+        """Return all meta-data for the given files.
+
+        Equivalent to :py:meth:`ExifTool.get_metadata_batch()`.
+        """
+        return self.execute_json_batch([], filenames)
+
+    def get_tags_batch(self, tags, filenames):
+        """Return only specified tags for the given files.
+
+        Equivalent to :py:meth:`ExifTool.get_tags_batch()`.
+        """
+        return self.execute_json_batch(_tag_params(tags, 0), filenames)
@@ -6,6 +6,7 @@ import unittest
 import exiftool
 import warnings
 import os
+import signal
 
 class TestExifTool(unittest.TestCase):
     def setUp(self):
@@ -67,6 +68,11 @@ class TestExifTool(unittest.TestCase):
             actual_data = self.et.get_metadata_batch(source_files)
             tags0 = self.et.get_tags(["XMP:Subject"], source_files[0])
             tag0 = self.et.get_tag("XMP:Subject", source_files[0])
+            streamed_data = list(self.et.iter_metadata(iter(source_files), 1))
+            streamed_tags = list(self.et.iter_tags(["XMP:Subject"],
+                                                   source_files, 1))
+            fast_tags = list(self.et.iter_tags(["XMP:Subject"],
+                                               source_files, fast=2))
         for expected, actual in zip(expected_data, actual_data):
             et_version = actual["ExifTool:ExifToolVersion"]
             self.assertTrue(isinstance(et_version, float))
@@ -77,10 +83,73 @@ class TestExifTool(unittest.TestCase):
             actual["SourceFile"] = os.path.normpath(actual["SourceFile"])
             for k, v in expected.items():
                 self.assertEqual(actual[k], v)
+        self.assertEqual(streamed_data, actual_data)
+        self.assertEqual([d["SourceFile"] for d in streamed_tags],
+                         [d["SourceFile"] for d in actual_data])
+        self.assertEqual(streamed_tags[0]["XMP:Subject"], "Röschen")
+        self.assertEqual(fast_tags, streamed_tags)
         tags0["SourceFile"] = os.path.normpath(tags0["SourceFile"])
         self.assertEqual(tags0, dict((k, expected_data[0][k])
                                      for k in ["SourceFile", "XMP:Subject"]))
         self.assertEqual(tag0, "Röschen")
 
+class TestExifToolPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = exiftool.ExifToolPool(2, chunk_size=3)
+        script_path = os.path.dirname(__file__)
+        self.source_files = [os.path.join(script_path, f)
+                             for f in ["rose.jpg", "skyblue.png"] * 5]
+    def tearDown(self):
+        self.pool.terminate()
+    def test_not_running(self):
+        self.assertFalse(self.pool.running)
+        self.assertRaises(ValueError, self.pool.get_metadata_batch,
+                          self.source_files)
+    def test_get_metadata_batch(self):
+        # Results of a pool should be in input order and equal to
+        # those of a single instance
+        with exiftool.ExifTool() as et:
+            expected = et.get_metadata_batch(self.source_files)
+        with self.pool:
+            self.assertTrue(self.pool.running)
+            actual = self.pool.get_metadata_batch(self.source_files)
+            tags = self.pool.get_tags_batch(["XMP:Subject"],
+                                            self.source_files[:2])
+        self.assertFalse(self.pool.running)
+        self.assertEqual(actual, expected)
+        self.assertEqual(tags[0]["XMP:Subject"], "Röschen")
+        self.assertFalse("XMP:Subject" in tags[1])
+    def test_iter_metadata(self):
+        # Streamed results should be in input order, also when the
+        # iteration is abandoned early
+        with self.pool:
+            expected = self.pool.get_metadata_batch(self.source_files)
+            actual = list(self.pool.iter_metadata(iter(self.source_files), 1))
+            partial = self.pool.iter_metadata(self.source_files)
+            first = next(partial)
+            partial.close()
+            self.assertEqual(list(self.pool.iter_metadata([])), [])
+        self.assertEqual(actual, expected)
+        self.assertEqual(first, expected[0])
+    def test_restart(self):
+        # A worker whose process died should be restarted transparently
+        with self.pool:
+            expected = self.pool.get_metadata_batch(self.source_files)
+            os.kill(self.pool._workers[0]._process.pid, signal.SIGKILL)
+            self.pool._workers[0]._process.wait()
+            actual = self.pool.get_metadata_batch(self.source_files)
+            self.assertEqual(self.pool.restarts, 1)
+        self.assertEqual(actual, expected)
+    def test_error(self):
+        # Errors of a chunk should be raised to the consumer, as they
+        # would be by a single instance, rather than leave it waiting
+        # for the chunk
+        missing = [os.path.join(os.path.dirname(__file__), "missing.jpg")] * 3
+        with exiftool.ExifTool() as et:
+            self.assertRaises(ValueError, et.get_metadata_batch, missing)
+        with self.pool:
+            self.assertRaises(ValueError, self.pool.get_metadata_batch,
+                              self.source_files[:3] + missing)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,175 @@
+"""
+Helpers for testing apple-photos-export.py. Since the script parses its
+arguments and configuration when it's loaded, each test loads a fresh copy of
+it, pointed at a target directory with its own configuration and a synthetic
+library (see benchmarks/synthetic_library.py), using the stand-in sips and
+exiftool commands in benchmarks/stand-ins.
+"""
+
+import io
+import os
+import sys
+import atexit
+import sqlite3
+import tempfile
+import configparser
+import unittest
+import contextlib
+import importlib.util
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(TESTS)
+SCRIPT = os.path.join(REPO, "apple-photos-export.py")
+BENCHMARKS = os.path.join(REPO, "benchmarks")
+STAND_INS = os.path.join(BENCHMARKS, "stand-ins")
+
+sys.path.insert(0, REPO)
+sys.path.insert(0, BENCHMARKS)
+import synthetic_library
+
+CONFIG = """[Paths]
+ApplePhotosLibrary = {library}
+TemporaryStorage = {tmp}
+
+[Conversion]
+Backend = sips
+Sips = {sips}
+
+[Metadata]
+ExifToolProcesses = 2
+"""
+
+def load_script(target, *args):
+    """
+    Loads a fresh copy of the script as if it had been run as
+    apple-photos-export.py TARGET [ARGS...], without running main().
+    """
+    argv = sys.argv
+    sys.argv = [SCRIPT, target, *args]
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            spec = importlib.util.spec_from_file_location("apple_photos_export", SCRIPT)
+            script = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(script)
+    finally:
+        sys.argv = argv
+    return script
+
+def add_master(library, path, content, importgroup, uti="public.heic", timestamp=570000000, versions=1, edited=False):
+    """
+    Adds a photo (or, depending on the UTI, another kind of master) with the
+    given content to a synthetic library, in the same way Photos would have
+    imported it, with the given number of versions (edited ones, if so
+    requested – rendering them is up to the caller). Returns its path.
+    """
+    master = os.path.join(library, "Masters", path)
+    os.makedirs(os.path.dirname(master), exist_ok=True)
+    with open(master, "w") as f:
+        f.write(content)
+
+    db = sqlite3.connect(os.path.join(library, "database", "photos.db"))
+    with db:
+        id = db.execute("SELECT COALESCE(MAX(modelId), 0) + 1 FROM RKMaster").fetchone()[0]
+        uuid = "TEST-MASTER-" + str(id)
+        contentidentifier = "TEST-CONTENT-" + str(id)
+        db.execute("INSERT INTO RKMaster VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, ?, ?, 4032, 3024, 0)",
+                   (id, uuid, path, os.path.basename(path), timestamp, timestamp, contentidentifier, contentidentifier, uti, importgroup))
+        for i in range(versions):
+            db.execute("INSERT INTO RKVersion (uuid, masterUuid, selfPortrait, adjustmentUuid) VALUES (?, ?, 0, ?)",
+                       ("TEST-VERSION-" + str(id) + "-" + str(i), uuid, "TEST-ADJUSTMENT" if edited else "UNADJUSTEDNONRAW"))
+    db.close()
+    return master
+
+class ExportTestCase(unittest.TestCase):
+    """
+    Runs the script against a synthetic library with the given number of
+    masters, with the given configuration on top of CONFIG as {section: {key:
+    value}}.
+    """
+    masters = 40
+    seed = 0
+    config = {}
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="apple-photos-export-test-")
+        self.library = os.path.join(self.tmpdir.name, "Test.photoslibrary")
+        self.target = os.path.join(self.tmpdir.name, "target")
+        synthetic_library.generate(self.library, self.masters, self.seed)
+        os.makedirs(self.target)
+        self.configure(self.config)
+
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = STAND_INS + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        self.tmpdir.cleanup()
+
+    def configure(self, config):
+        conf = configparser.ConfigParser()
+        conf.optionxform = str
+        conf.read_string(CONFIG.format(library=self.library,
+                                       tmp=os.path.join(self.tmpdir.name, "tmp"),
+                                       sips=os.path.join(STAND_INS, "sips")))
+        for section, options in config.items():
+            if not conf.has_section(section):
+                conf.add_section(section)
+            for key, value in options.items():
+                conf.set(section, key, str(value))
+        with open(os.path.join(self.target, "apple-photos-export.ini"), "w") as f:
+            conf.write(f)
+
+    def export(self, confirm=True, script=None):
+        """
+        Runs the script (answering its confirmation prompt as given) and
+        returns it, for looking at its globals. A script loaded beforehand can
+        be passed in, e.g. after patching it.
+        """
+        script = script or load_script(self.target)
+        script.input = lambda prompt: "y" if confirm else "N"
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                script.main()
+            except SystemExit:
+                if confirm:
+                    raise
+            finally:
+                script.clean_up()
+                atexit.unregister(script.clean_up)
+        return script
+
+    def exported(self):
+        """
+        Returns the paths of the files in the year/month tree of the target,
+        relative to it.
+        """
+        paths = set()
+        for directory, _, files in os.walk(self.target):
+            rel = os.path.relpath(directory, self.target)
+            if rel.split(os.sep)[0].isdigit():
+                paths.update(os.path.join(rel, f) for f in files)
+        return paths
+
+    def state(self, q, *params):
+        db = sqlite3.connect(os.path.join(self.target, "apple-photos-export.db"))
+        try:
+            with db:
+                return db.execute(q, params).fetchall()
+        finally:
+            db.close()
+
+    def photos(self, q, *params):
+        db = sqlite3.connect(os.path.join(self.library, "database", "photos.db"))
+        try:
+            with db:
+                return db.execute(q, params).fetchall()
+        finally:
+            db.close()
+
+    def forget_import_groups(self):
+        # such that the next run looks at all media again
+        self.state("DELETE FROM import_groups")
+
+    def read(self, path):
+        with open(os.path.join(self.target, path), "rb") as f:
+            return f.read()
@@ -0,0 +1,81 @@
+import os
+import unittest
+
+from tests.helpers import ExportTestCase, load_script
+
+class TestConflicts(ExportTestCase):
+    def test_rerun_stages_nothing(self):
+        self.export()
+        exported = self.exported()
+        self.forget_import_groups()
+
+        # everything is already in the target, so nothing is staged, copied
+        # or converted
+        script = self.export()
+        self.assertEqual(script.COUNTERS.get("identical"), len(exported))
+        self.assertEqual(script.TMP_FILES, [])
+        for counter in ["files", "bytes", "conversions", "cached_conversions"]:
+            self.assertNotIn(counter, script.COUNTERS)
+        self.assertEqual(self.exported(), exported)
+
+    def test_conflict(self):
+        self.export()
+        path = next(p for p in self.exported() if p.endswith(".heic"))
+        os.remove(os.path.join(self.target, path))  # rather than change the files hardlinked to it
+        with open(os.path.join(self.target, path), "w") as f:
+            f.write("different")
+        self.forget_import_groups()
+
+        # the file in the way is kept, the exported one is written next to it
+        script = self.export()
+        source = script.SOURCES[os.path.join(script.STAGE, path)]
+        alternative = path[:-len(".heic")] + "_conflict_" + script.full_checksum(source)[:8] + ".heic"
+        self.assertEqual(self.read(path), b"different")
+        with open(source, "rb") as f:
+            self.assertEqual(self.read(alternative), f.read())
+        self.assertEqual(script.CONFLICTS, [{"path": path, "written_to": alternative}])
+        self.assertEqual(self.state("SELECT source FROM exported_files WHERE path = ?", alternative), [(source,)])
+        warnings = script.COUNTERS["warnings"]
+
+        # reruns recognize the file written instead, without warning about it
+        # again or staging anything
+        self.forget_import_groups()
+        script = self.export()
+        self.assertEqual(script.CONFLICTS, [])
+        self.assertEqual(script.TMP_FILES, [])
+        self.assertEqual(script.COUNTERS.get("warnings", 0), warnings - 1)
+        self.assertIn(alternative, self.exported())
+
+    def test_classify_writes(self):
+        script = load_script(self.target)
+        def write(path, content):
+            with open(path, "w") as f:
+                f.write(content)
+            return path
+
+        source = lambda name: os.path.join(self.tmpdir.name, name)
+        target = lambda name: os.path.join(self.target, name)
+        new = write(source("new"), "new")
+        same = write(source("same"), "same")
+        write(target("same"), "same")
+        different = write(source("different"), "different")
+        write(target("different"), "something else")
+        again = write(source("again"), "again")
+        write(target("again"), "something else")
+        write(script.conflict_path(again, target("again")), "again")
+        existing = {p: tuple(script.identity(p)) for p in [target("same"), target("different"), target("again"), script.conflict_path(again, target("again"))]}
+
+        writes, identical, conflicts = script.classify_writes([
+            (new, target("new")),
+            (same, target("same")),
+            (different, target("different")),
+            (again, target("again"))
+        ], existing)
+        self.assertEqual(writes, [(new, target("new")), (different, script.conflict_path(different, target("different")))])
+        self.assertEqual(identical, [(same, target("same")), (again, script.conflict_path(again, target("again")))])
+        self.assertEqual(conflicts, [(different, target("different"), script.conflict_path(different, target("different"))),
+                                     (again, target("again"), script.conflict_path(again, target("again")))])
+        self.assertRegex(script.conflict_path(different, target("x.heic")), r"/x_conflict_[0-9a-f]{8}\.heic$")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import json
+import unittest
+
+from tests.helpers import ExportTestCase, add_master, load_script
+
+class TestDeduplication(ExportTestCase):
+    # masters of the synthetic library have (fewer than 64) distinct contents
+    # per file type, so there are plenty of duplicates
+    masters = 60
+
+    def contents(self):
+        # exported paths by content
+        contents = {}
+        for path in self.exported():
+            contents.setdefault(self.read(path), []).append(path)
+        return contents
+
+    def report(self):
+        with open(os.path.join(self.target, "apple-photos-export-report.json")) as f:
+            return json.load(f)
+
+    def inode(self, path):
+        return os.stat(os.path.join(self.target, path)).st_ino
+
+    def test_link(self):
+        self.export()
+        contents = self.contents()
+        self.assertLess(len(contents), len(self.exported()))
+        for paths in contents.values():
+            self.assertEqual(len(set(self.inode(p) for p in paths)), 1)
+
+        duplicates = self.report()["duplicates"]
+        self.assertEqual(len(duplicates), len(self.exported()) - len(contents))
+        for d in duplicates:
+            self.assertEqual(self.inode(d["path"]), self.inode(d["original"]))
+            self.assertNotEqual(d["path"], d["original"])
+
+    def test_skip(self):
+        self.configure({"Copying": {"Deduplication": "skip"}})
+        self.export()
+        self.assertTrue(all(len(paths) == 1 for paths in self.contents().values()))
+        for d in self.report()["duplicates"]:
+            self.assertNotIn(d["path"], self.exported())
+            self.assertIn(d["original"], self.exported())
+        self.assertEqual(self.state("SELECT * FROM exported_files WHERE path IN (SELECT value FROM json_each(?))",
+                                    json.dumps([d["path"] for d in self.report()["duplicates"]])), [])
+
+    def test_off(self):
+        self.configure({"Copying": {"Deduplication": "off"}})
+        self.export()
+        self.assertEqual(self.report()["duplicates"], [])
+        for path in self.exported():
+            self.assertEqual(os.stat(os.path.join(self.target, path)).st_nlink, 1)
+
+    def test_duplicate_of_earlier_run(self):
+        self.export()
+        path = next(p for p in self.exported() if p.endswith(".heic"))
+        add_master(self.library, "2019/01/01/again/IMG_9999.HEIC", self.read(path).decode(), "AGAIN")
+        self.export()
+        again = next(p for p in self.exported() if p.endswith("IMG_9999.heic"))
+        self.assertEqual(self.inode(again), self.inode(path))
+        self.assertEqual([d["path"] for d in self.report()["duplicates"]], [again, again[:-len(".heic")] + ".jpg"])
+
+    def test_master_with_several_versions(self):
+        self.export()
+        for mode in ["link", "skip", "off"]:
+            with self.subTest(mode):
+                self.configure({"Copying": {"Deduplication": mode}})
+                content = "several versions " + mode
+                add_master(self.library, "2019/01/01/" + mode + "/IMG_9999.HEIC", content, "VERSIONS-" + mode.upper(), versions=2)
+                script = self.export()
+                exported = [p for p in self.exported() if p.endswith("IMG_9999.heic") and self.read(p) == content.encode()]
+                self.assertEqual(len(exported), 1)
+                self.assertEqual(script.TALLY["written"]["Photos"], 2)  # once per version, as always
+
+    def test_listed_twice(self):
+        script = load_script(self.target)
+        script.connect_state()
+        try:
+            sources = []
+            for name in ["a", "b"]:
+                sources.append(os.path.join(self.tmpdir.name, name))
+                with open(sources[-1], "w") as f:
+                    f.write("same")
+            x = os.path.join(self.target, "x")
+            y = os.path.join(self.target, "y")
+            unique, duplicates = script.deduplicate([(sources[0], x), (sources[0], x), (sources[1], y)])
+            self.assertEqual(unique, [(sources[0], x)])
+            self.assertEqual(duplicates, [(sources[1], y, x)])
+        finally:
+            script.close_state()
+
+if __name__ == "__main__":
+    unittest.main()
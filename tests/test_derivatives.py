@@ -0,0 +1,64 @@
+import os
+import shutil
+import unittest
+
+from tests.helpers import ExportTestCase, load_script
+
+class TestDerivativeCache(ExportTestCase):
+    def cached(self, script):
+        if not os.path.isdir(script.DERIVATIVE_CACHE):
+            return []
+        return os.listdir(script.DERIVATIVE_CACHE)
+
+    def test_rename(self):
+        # JPEG versions staged within the target aren't copied into the cache
+        # (only cloned, where the file system allows)
+        script = load_script(self.target)
+        script.clone_file = lambda sourcepath, targetpath: False
+        self.export(script=script)
+        self.assertEqual(script.STAGING, "rename")
+        self.assertTrue(script.COUNTERS["conversions"])
+        self.assertEqual(self.cached(script), [])
+
+    def test_reuse(self):
+        # with the other strategies, they're converted once across runs, even
+        # if the TARGET is started over
+        self.configure({"Staging": {"Strategy": "copy"}})
+        script = self.export()
+        conversions = script.COUNTERS["conversions"]
+        self.assertEqual(len(self.cached(script)), conversions)
+
+        for name in os.listdir(self.target):
+            if name.isdigit():
+                shutil.rmtree(os.path.join(self.target, name))
+        os.remove(os.path.join(self.target, "apple-photos-export.db"))
+        script = self.export()
+        self.assertEqual(script.COUNTERS.get("conversions", 0), 0)
+        self.assertEqual(script.COUNTERS["cached_conversions"], conversions)
+
+    def test_eviction(self):
+        script = load_script(self.target)
+        script.STAGING = "copy"
+        script.DERIVATIVE_CACHE = os.path.join(self.tmpdir.name, "derivatives")
+        heicfiles = {}
+        for name in ["a", "b", "c"]:
+            heicfiles[name] = os.path.join(self.tmpdir.name, name + ".heic")
+            jpegfile = os.path.join(self.tmpdir.name, name + ".jpg")
+            for path in [heicfiles[name], jpegfile]:
+                with open(path, "w") as f:
+                    f.write(name * 100)
+            script.cache_derivative(heicfiles[name], jpegfile)
+        for i, name in enumerate(["a", "b", "c"]):
+            os.utime(script.derivative_path(heicfiles[name]), (1000 + i, 1000 + i))
+
+        # using a cached version makes it the most recently used one, so the
+        # least recently used one is b now
+        self.assertTrue(script.cached_derivative(heicfiles["a"], os.path.join(self.tmpdir.name, "out.jpg")))
+        script.DERIVATIVE_CACHE_SIZE = 200
+        script.evict_derivatives()
+        for name, kept in [("a", True), ("b", False), ("c", True)]:
+            self.assertEqual(os.path.isfile(script.derivative_path(heicfiles[name])), kept)
+        self.assertEqual(script.COUNTERS["evicted_derivatives"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
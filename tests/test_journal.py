@@ -0,0 +1,128 @@
+import os
+import unittest
+
+from tests.helpers import ExportTestCase, load_script
+
+class TestJournal(ExportTestCase):
+    # run once per staging strategy, see the subclasses below
+    config = {"Staging": {"Strategy": "rename"}}
+
+    def staged(self, script):
+        # target paths of the files a run has staged, relative to the target
+        return set(os.path.relpath(path, script.STAGE) for path, _ in script.TMP_FILES)
+
+    def in_stage(self, script):
+        # the files actually in the staging directory (in the manifest
+        # strategy, only JPEG versions are)
+        return [path for path, sourcepath in script.TMP_FILES if sourcepath is None]
+
+    def journaled(self, script):
+        # patches script to collect the units of work it journals
+        units = []
+        journal = script.journal
+        def collect(unit, *args):
+            journal(unit, *args)
+            units.append(unit)
+        script.journal = collect
+        return units
+
+    def test_resume_after_declining(self):
+        declined = self.export(confirm=False)
+        staged = self.staged(declined)
+        self.assertTrue(staged)
+        self.assertEqual(self.exported(), set())
+        self.assertTrue(os.path.isfile(os.path.join(declined.STAGE, ".apple-photos-export-journal")))
+
+        # nothing needs to be staged or converted again
+        script = load_script(self.target)
+        units = self.journaled(script)
+        self.export(script=script)
+        self.assertEqual(script.COUNTERS.get("resumed"), len(self.in_stage(declined)))
+        self.assertEqual(set(units), {"persist"})
+        self.assertEqual(script.COUNTERS.get("conversions", 0), 0)
+        self.assertEqual(script.COUNTERS.get("cached_conversions", 0), 0)
+        self.assertEqual(self.exported(), staged)
+        if script.STAGING == "rename":
+            self.assertFalse(os.path.exists(script.STAGE))
+
+    def test_redo_changed_staged_file(self):
+        declined = self.export(confirm=False)
+        staged = self.staged(declined)
+        path = self.in_stage(declined)[0]
+        with open(path, "rb") as f:
+            content = f.read()
+        os.remove(path)  # rather than change the master hardlinked to it
+        with open(path, "w") as f:
+            f.write("truncated")
+
+        script = self.export()
+        self.assertEqual(script.COUNTERS.get("resumed"), len(self.in_stage(declined)) - 1)
+        self.assertEqual(self.exported(), staged)
+        self.assertEqual(self.read(os.path.relpath(path, declined.STAGE)), content)
+
+    def test_resume_interrupted_persisting(self):
+        script = load_script(self.target)
+        journal = script.journal
+        persisted = []
+        def interrupt(unit, *args):
+            # once a JPEG version has been persisted along with a few others
+            converted = set(p for p, sourcepath in script.TMP_FILES if sourcepath is None and p.endswith(".jpg"))
+            if unit == "persist" and len(persisted) >= 5 and converted.intersection(persisted):
+                raise KeyboardInterrupt
+            journal(unit, *args)
+            if unit == "persist":
+                persisted.append(args[0])
+        script.journal = interrupt
+        with self.assertRaises(KeyboardInterrupt):
+            self.export(script=script)
+        staged = self.staged(script)
+        # the file being persisted at the time (and, when copying, the ones
+        # being copied along with it) without a journal entry
+        self.assertGreater(len(self.exported()), len(persisted))
+        self.assertLess(len(self.exported()), len(staged))
+        self.assertTrue(os.path.isdir(script.STAGE))
+
+        # the files persisted before the interruption are left alone, the
+        # others are persisted from the staging directory
+        script = self.export()
+        self.assertEqual(self.exported(), staged)
+        self.assertEqual(script.COUNTERS.get("bytes", 0), 0)
+        self.assertEqual(script.COUNTERS.get("conversions", 0), 0)
+        for rel in staged:
+            if rel.endswith(".jpg"):
+                continue  # converted rather than copied
+            with open(script.SOURCES[os.path.join(script.STAGE, rel)], "rb") as f:
+                self.assertEqual(self.read(rel), f.read())
+
+class TestJournalLink(TestJournal):
+    config = {"Staging": {"Strategy": "link"}}
+
+class TestJournalCopy(TestJournal):
+    config = {"Staging": {"Strategy": "copy"}}
+
+class TestJournalManifest(TestJournal):
+    config = {"Staging": {"Strategy": "manifest"}, "Conversion": {"CacheSize": 0}}
+
+class TestSwitchingStrategies(ExportTestCase):
+    def test_copy_over_link(self):
+        # the files staged with the link strategy are hardlinks to the masters,
+        # which staging them again mustn't write into
+        self.configure({"Staging": {"Strategy": "link"}})
+        declined = self.export(confirm=False)
+        masters = {}
+        for path, _ in declined.TMP_FILES:
+            if path.endswith(".heic"):
+                master = declined.SOURCES[path]
+                with open(master, "rb") as f:
+                    masters[master] = f.read()
+                os.utime(master)
+
+        self.configure({"Staging": {"Strategy": "copy"}})
+        self.export()
+        self.assertTrue(masters)
+        for master, content in masters.items():
+            with open(master, "rb") as f:
+                self.assertEqual(f.read(), content)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import json
+import sqlite3
+import unittest
+
+from tests.helpers import ExportTestCase, add_master, load_script
+
+class TestMigration(ExportTestCase):
+    def import_groups(self):
+        db = sqlite3.connect(os.path.join(self.library, "database", "photos.db"))
+        try:
+            return [r[0] for r in db.execute("SELECT DISTINCT importGroupUuid FROM RKMaster")]
+        finally:
+            db.close()
+
+    def write_json(self, name, data):
+        with open(os.path.join(self.target, name), "w") as f:
+            json.dump(data, f)
+
+    def test_migrate_json_cache(self):
+        groups = self.import_groups()
+        self.write_json("apple-photos-export.json", {
+            "IGNORE_IMPORT_GROUPS": groups + [None],
+            "LIVE_PHOTO_VIDEOS": {"MIGRATED-CONTENT": "/migrated/video.mov"}
+        })
+        self.write_json("apple-photos-export-metadata.json", {
+            "CACHED_TAGS": load_script(self.target).CACHED_TAGS,
+            "FILES": {"/migrated/video.mov": [1, 2, {"QuickTime:ContentIdentifier": "MIGRATED-CONTENT"}]}
+        })
+
+        # import groups exported by earlier versions stay exported
+        script = self.export()
+        self.assertEqual(self.exported(), set())
+        self.assertEqual(script.TALLY["written"], {})
+
+        self.assertEqual(sorted(r[0] for r in self.state("SELECT uuid FROM import_groups")), sorted(groups + [""]))
+        self.assertEqual(self.state("SELECT path FROM live_photo_videos WHERE contentidentifier = 'MIGRATED-CONTENT'"), [("/migrated/video.mov",)])
+        self.assertEqual(self.state("SELECT size, mtime_ns, tags FROM metadata WHERE path = '/migrated/video.mov'"),
+                         [(1, 2, json.dumps({"QuickTime:ContentIdentifier": "MIGRATED-CONTENT"}))])
+        for name in ["apple-photos-export.json", "apple-photos-export-metadata.json"]:
+            self.assertFalse(os.path.exists(os.path.join(self.target, name)))
+            self.assertTrue(os.path.isfile(os.path.join(self.target, name + ".migrated")))
+
+        # which only happens once
+        self.export()
+        self.assertEqual(len(self.state("SELECT * FROM import_groups")), len(groups) + 1)
+
+    def test_skip_metadata_of_other_tags(self):
+        self.write_json("apple-photos-export-metadata.json", {
+            "CACHED_TAGS": ["System:FileName"],
+            "FILES": {"/migrated/video.mov": [1, 2, {"System:FileName": "video.mov"}]}
+        })
+        self.export()
+        self.assertEqual(self.state("SELECT * FROM metadata WHERE path = '/migrated/video.mov'"), [])
+        self.assertTrue(os.path.isfile(os.path.join(self.target, "apple-photos-export-metadata.json.migrated")))
+        self.assertTrue(self.exported())
+
+    def test_drop_rendered_versions(self):
+        # which earlier versions kept in the export state
+        self.state("CREATE TABLE rendered_versions (path TEXT PRIMARY KEY, kind TEXT, contentidentifier TEXT, timestamp INTEGER)")
+        self.state("CREATE TABLE rendered_slomos (timestamp INTEGER PRIMARY KEY, path TEXT)")
+        self.export()
+        self.assertEqual(self.state("SELECT name FROM sqlite_master WHERE name LIKE 'rendered_%'"), [])
+
+class TestImportGroups(ExportTestCase):
+    config = {"Database": {"Mode": "readonly"}}
+
+    def test_import_during_run(self):
+        # with the library's database accessed in place, Photos may add an
+        # import group while media are being exported
+        script = load_script(self.target)
+        persist_files_to_target = script.persist_files_to_target
+        def import_and_persist():
+            add_master(self.library, "2019/01/01/late/IMG_9999.HEIC", "late", "LATE-GROUP")
+            persist_files_to_target()
+        script.persist_files_to_target = import_and_persist
+        self.export(script=script)
+        self.assertEqual(self.state("SELECT * FROM import_groups WHERE uuid = 'LATE-GROUP'"), [])
+        self.assertFalse(any("IMG_9999" in p for p in self.exported()))
+
+        # so it's exported by the next run
+        self.export()
+        self.assertEqual(len(self.state("SELECT * FROM import_groups WHERE uuid = 'LATE-GROUP'")), 1)
+        self.assertTrue(any(p.endswith("IMG_9999.heic") for p in self.exported()))
+
+    def test_no_import_group(self):
+        # masters without an import group are exported once, like the others
+        add_master(self.library, "2019/01/01/none/IMG_9999.HEIC", "no import group", None)
+        script = self.export()
+        self.assertTrue(any(p.endswith("IMG_9999.heic") for p in self.exported()))
+        self.assertEqual(len(self.state("SELECT * FROM import_groups WHERE uuid = ''")), 1)
+
+        script = self.export()
+        self.assertEqual(script.TALLY["written"], {})
+        self.assertEqual(script.MEDIA_TOTAL, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import random
+import tempfile
+import unittest
+
+from tests.helpers import CONFIG, load_script
+
+class TestTemporalIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.TemporaryDirectory() as target:
+            with open(os.path.join(target, "apple-photos-export.ini"), "w") as f:
+                f.write(CONFIG.format(library=target, tmp=target, sips="sips"))
+            cls.TemporalIndex = load_script(target).TemporalIndex
+
+    def brute_force(self, items, timestamp, tolerance):
+        candidates = [(abs(t - timestamp), i) for i, (t, _) in enumerate(sorted(items, key=lambda i: i[0]))
+                      if abs(t - timestamp) <= tolerance]
+        if not candidates:
+            return None, False
+        return sorted(items, key=lambda i: i[0])[min(candidates)[1]][1], len(candidates) > 1
+
+    def test_empty(self):
+        index = self.TemporalIndex([])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.nearest(100, 2), (None, False))
+        self.assertEqual(index.match_all([100, 200], 2), {100: (None, False), 200: (None, False)})
+        self.assertEqual(index.match_all([], 2), {})
+
+    def test_window_edges(self):
+        # the window includes both of its edges, but nothing beyond them
+        index = self.TemporalIndex([(100, "a")])
+        for timestamp in [98, 100, 102]:
+            self.assertEqual(index.nearest(timestamp, 2), ("a", False))
+            self.assertEqual(index.match_all([timestamp], 2)[timestamp], ("a", False))
+        for timestamp in [97, 103]:
+            self.assertEqual(index.nearest(timestamp, 2), (None, False))
+            self.assertEqual(index.match_all([timestamp], 2)[timestamp], (None, False))
+        self.assertEqual(index.nearest(100, 0), ("a", False))
+        self.assertEqual(index.nearest(101, 0), (None, False))
+
+    def test_nearest_and_ambiguity(self):
+        index = self.TemporalIndex([(110, "c"), (100, "a"), (103, "b")])
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.nearest(100, 1), ("a", False))
+        self.assertEqual(index.nearest(101, 2), ("a", True))
+        self.assertEqual(index.nearest(102, 2), ("b", True))
+        self.assertEqual(index.nearest(108, 2), ("c", False))
+        self.assertEqual(index.nearest(106, 3), ("b", False))
+        self.assertEqual(index.nearest(106, 4), ("b", True))
+        self.assertEqual(index.nearest(105, 5), ("b", True))
+
+        # ties go to the earlier value, and are ambiguous
+        tie = self.TemporalIndex([(102, "later"), (98, "earlier")])
+        self.assertEqual(tie.nearest(100, 2), ("earlier", True))
+
+    def test_same_timestamp(self):
+        index = self.TemporalIndex([(100, "a"), (100, "b")])
+        value, ambiguous = index.nearest(100, 0)
+        self.assertIn(value, ["a", "b"])
+        self.assertTrue(ambiguous)
+
+    def test_match_all_matches_nearest(self):
+        rnd = random.Random(0)
+        for tolerance in [0, 1, 2, 10]:
+            items = [(rnd.randint(0, 500), i) for i in range(100)]
+            index = self.TemporalIndex(items)
+            timestamps = [rnd.randint(-20, 520) for _ in range(300)]
+            matches = index.match_all(timestamps, tolerance)
+            self.assertEqual(set(matches.keys()), set(timestamps))
+            for timestamp in timestamps:
+                self.assertEqual(matches[timestamp], index.nearest(timestamp, tolerance))
+                self.assertEqual(matches[timestamp], self.brute_force(items, timestamp, tolerance))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import json
+import unittest
+
+from tests.helpers import ExportTestCase, load_script
+
+class TestEditedVersions(ExportTestCase):
+    def edited(self):
+        # content identifiers of the synthetic library's edited photos
+        return [r[0] for r in self.photos("""SELECT m.mediaGroupId FROM RKMaster m JOIN RKVersion v ON m.uuid = v.masterUuid
+                                             WHERE v.adjustmentUuid != 'UNADJUSTEDNONRAW'""")]
+
+    def rendered(self):
+        # rendered versions of edited photos and their live photo videos by
+        # content identifier, as (kind, path) tuples
+        rendered = {}
+        for directory, _, files in os.walk(os.path.join(self.library, "resources", "media", "version")):
+            for f in files:
+                if f.startswith("fullsizeoutput_") and f.endswith(".mov"):
+                    continue  # rendered slomo
+                with open(os.path.join(directory, f)) as g:
+                    tags = json.load(g)
+                contentidentifier = tags.get("Apple:ContentIdentifier", tags.get("QuickTime:ContentIdentifier"))
+                rendered.setdefault(contentidentifier, []).append(os.path.join(directory, f))
+        return rendered
+
+    def export_logging(self):
+        script = load_script(self.target)
+        messages = []
+        log = script.log
+        def logging(msg, type="status"):
+            messages.append(msg)
+            log(msg, type)
+        script.log = logging
+        self.export(script=script)
+        return script, messages
+
+    def test_edited_photos(self):
+        edited = self.edited()
+        self.assertTrue(edited)
+        script = self.export()
+
+        # exported next to the original, along with edited live photo videos
+        rendered = self.rendered()
+        versions = [p for c in edited for p in rendered[c]]
+        exported = [p for p in self.exported() if "_edited_" in p]
+        self.assertEqual(len(exported), len(versions))
+        for path in versions:
+            name = next(p for p in exported if p.endswith("_edited_" + os.path.basename(path)))
+            with open(path, "rb") as f:
+                self.assertEqual(self.read(name), f.read())
+        self.assertEqual(script.TALLY["written"]["Edited photos"], len(edited))
+
+    def test_without_content_identifier(self):
+        # photos recognized as such only by their grouping UUID have no content
+        # identifier to match rendered versions by, so their edits are left
+        # out, without warning about them on every run
+        edited = self.edited()
+        contentidentifier = edited[0]
+        self.photos("UPDATE RKMaster SET mediaGroupId = NULL WHERE mediaGroupId = ?", contentidentifier)
+        script, messages = self.export_logging()
+        self.assertFalse([m for m in messages if m.startswith("Couldn't find edited version")])
+        self.assertEqual(script.TALLY["ignored"]["Edits of photos without content identifier"], 1)
+        self.assertEqual(script.TALLY["written"]["Edited photos"], len(edited) - 1)
+        for path in self.rendered()[contentidentifier]:
+            self.assertFalse(any(p.endswith("_edited_" + os.path.basename(path)) for p in self.exported()))
+
+if __name__ == "__main__":
+    unittest.main()
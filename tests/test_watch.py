@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import unittest
+
+from tests.helpers import ExportTestCase, add_master, load_script
+
+# polling interval, never actually waited for (see TestWatch.watch)
+INTERVAL = 1000
+
+class TestWatch(ExportTestCase):
+    def watch(self, polls):
+        """
+        Runs the script with --watch, calling each of polls instead of waiting
+        for the next poll, and stopping it (as if by Ctrl-C) after the last.
+        Returns the script, and whether each of its exports was completed.
+        """
+        script = load_script(self.target, "--watch", str(INTERVAL))
+        exports = []
+        export = script.export
+        def completed(confirm):
+            exports.append(export(confirm))
+            return exports[-1]
+        script.export = completed
+
+        polls = iter(polls)
+        class Clock:
+            def __getattr__(self, name):
+                return getattr(time, name)
+            def sleep(self, seconds):
+                if seconds != INTERVAL:
+                    return time.sleep(seconds)
+                poll = next(polls, None)
+                if poll is None:
+                    raise KeyboardInterrupt
+                poll()
+        script.time = Clock()
+        self.export(script=script)
+        return script, exports
+
+    def recorded(self, group):
+        return bool(self.state("SELECT * FROM import_groups WHERE uuid = ?", group))
+
+    def render(self, contentidentifier):
+        # as Photos does once it has rendered an edit
+        path = os.path.join(self.library, "resources", "media", "version", "FF", "00", "fullsizeoutput_ffff.jpeg")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"Apple:ContentIdentifier": contentidentifier}, f)
+        return path
+
+    def test_settle(self):
+        # a group Photos is still adding to is exported once its number of
+        # masters has stayed the same between two polls
+        def first():
+            add_master(self.library, "2019/01/01/new/IMG_9998.HEIC", "first", "NEW")
+        def second():
+            self.assertFalse(self.recorded("NEW"))
+            add_master(self.library, "2019/01/01/new/IMG_9999.HEIC", "second", "NEW")
+        def unchanged():
+            self.assertFalse(self.recorded("NEW"))
+        script, exports = self.watch([first, second, unchanged, lambda: None])
+
+        # the library as it was when starting, and the new group once complete
+        self.assertEqual(exports, [True, True])
+        self.assertTrue(self.recorded("NEW"))
+        for name in ["IMG_9998.heic", "IMG_9999.heic"]:
+            self.assertTrue(any(p.endswith(name) for p in self.exported()))
+
+    def test_retry(self):
+        # an edit Photos hasn't rendered yet holds up the export of its group
+        # until it has
+        contentidentifier = []
+        def importing():
+            add_master(self.library, "2019/01/01/new/IMG_9999.HEIC", "edited", "NEW", edited=True)
+            contentidentifier.extend(r[0] for r in self.photos("SELECT mediaGroupId FROM RKMaster WHERE importGroupUuid = 'NEW'"))
+        def rendering():
+            self.assertFalse(self.recorded("NEW"))
+            self.render(contentidentifier[0])
+        script, exports = self.watch([importing, lambda: None, rendering])
+
+        # the group wasn't settled yet during the first export, so its warning
+        # didn't count then
+        self.assertEqual(exports, [True, False, True])
+        self.assertTrue(self.recorded("NEW"))
+        self.assertTrue(any(p.endswith("edited_fullsizeoutput_ffff.jpeg") for p in self.exported()))
+
+    def test_retries_exhausted(self):
+        self.configure({"Watch": {"Retries": 2}})
+        def importing():
+            add_master(self.library, "2019/01/01/new/IMG_9999.HEIC", "edited", "NEW", edited=True)
+        script, exports = self.watch([importing] + [lambda: None] * 4)
+        self.assertEqual(exports, [True, False, False, True])
+        self.assertTrue(self.recorded("NEW"))
+
+    def test_lasting_warnings(self):
+        # warnings that come up on every run, or that won't ever clear up,
+        # don't hold up exports: a video without a content identifier among
+        # the live photo videos, and a photo without a live photo video
+        mov = os.path.join(self.library, "resources", "media", "master", "FF", "00", "jpegvideocomplement_ffff.mov")
+        os.makedirs(os.path.dirname(mov), exist_ok=True)
+        with open(mov, "w") as f:
+            f.write("not a live photo video")
+        def importing():
+            add_master(self.library, "2019/01/01/new/IMG_9999.HEIC", "not live", "NEW")
+        script, exports = self.watch([importing, lambda: None])
+        self.assertEqual(exports, [True, True])
+        self.assertTrue(self.recorded("NEW"))
+        self.assertGreater(script.COUNTERS.get("warnings", 0), 0)
+        self.assertEqual(script.COUNTERS.get("retryable_warnings", 0), 0)
+
+if __name__ == "__main__":
+    unittest.main()